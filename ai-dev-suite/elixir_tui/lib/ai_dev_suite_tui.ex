@@ -1111,6 +1111,41 @@ defmodule AiDevSuiteTui do
   end
 
   defp run_research(query) do
+    case research_via_rag_serve(query) do
+      :unavailable -> run_research_cli(query)
+      result -> result
+    end
+  end
+
+  # `rag.py serve` keeps Chroma, BM25 and the reranker warm; use it when running
+  # (RAG_SERVE_URL, default http://127.0.0.1:41437), else shell out to rag.py.
+  defp research_via_rag_serve(query) do
+    url = String.trim_trailing(System.get_env("RAG_SERVE_URL", "http://127.0.0.1:41437"), "/") <> "/research"
+    body = Jason.encode!(%{"query" => query, "context_only" => true})
+    tmp = Path.join(System.tmp_dir!(), "rag_research_#{:erlang.unique_integer([:positive])}.json")
+    File.write!(tmp, body)
+    try do
+      case System.cmd("curl", [
+        "-s", "--max-time", "120", "--connect-timeout", "1",
+        "-X", "POST", url,
+        "-H", "Content-Type: application/json", "-d", "@#{tmp}"
+      ]) do
+        {output, 0} ->
+          case Jason.decode(output) do
+            {:ok, %{"context" => context}} when is_binary(context) -> {:ok, context}
+            {:ok, %{"error" => err}} when is_binary(err) -> {:error, err}
+            _ -> :unavailable
+          end
+        _ -> :unavailable
+      end
+    rescue
+      _ -> :unavailable
+    after
+      File.rm(tmp)
+    end
+  end
+
+  defp run_research_cli(query) do
     # --context-only: skip Ollama in rag script; we inject raw context into chat
     args = ["research", query, "--context-only"]
     if exec = System.find_executable("rag") do
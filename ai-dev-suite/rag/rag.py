@@ -3,11 +3,15 @@
 RAG – Full implementation per doc/rag/RAG_BEST_PRACTICES.md.
 Phases 1–5: MVP, retrieval, prompt, evaluation, production.
 """
+import contextlib
+import contextvars
+import functools
 import hashlib
 import json
 import os
 import re
 import sys
+import threading
 import time
 from pathlib import Path
 from datetime import datetime
@@ -23,6 +27,9 @@ CHUNK_OVERLAP = int(CHUNK_SIZE * 0.2)
 CHUNK_SIZE_TOKENS = 512
 CHUNK_OVERLAP_RATIO = 0.2
 SEPARATORS = ["\n\n", "\n", ". ", " "]
+# Directory levels stored per chunk as dir_1..dir_N metadata (source filters become equality predicates)
+PATH_DEPTH = int(os.environ.get("RAG_PATH_DEPTH", "8"))
+PATH_DEPTH_KEY = "rag:path_depth"   # Collection metadata: depth the index was built with
 
 # Retrieval
 TOP_K_RETRIEVE = 20   # Before rerank
@@ -110,38 +117,94 @@ def _split_md_by_sections(text: str, base_meta: dict) -> list[tuple[str, dict]]:
     return result if result else [(text, base_meta)]
 
 
-def _token_count(text: str, encoding: str = "cl100k_base") -> int:
+TOKEN_ENCODING = "cl100k_base"
+_encoders: dict = {}
+
+
+def _get_encoder(encoding: str = TOKEN_ENCODING):
+    """tiktoken encoder, loaded once per process (None if tiktoken or its BPE file is unavailable)."""
+    if encoding not in _encoders:
+        try:
+            import tiktoken
+            _encoders[encoding] = tiktoken.get_encoding(encoding)
+        except Exception:
+            _encoders[encoding] = None
+    return _encoders[encoding]
+
+
+def _token_count(text: str, encoding: str = TOKEN_ENCODING) -> int:
     """Count tokens. Uses tiktoken if available else ~4 chars/token heuristic."""
-    try:
-        import tiktoken
-        enc = tiktoken.get_encoding(encoding)
-        return len(enc.encode(text))
-    except Exception:
+    enc = _get_encoder(encoding)
+    if enc is None:
         return max(1, len(text) // 4)
+    return len(enc.encode(text, disallowed_special=()))
+
+
+def _token_counts(texts: list[str], encoding: str = TOKEN_ENCODING) -> list[int]:
+    """Token counts for many texts with one batched encode."""
+    enc = _get_encoder(encoding)
+    if enc is None:
+        return [max(1, len(t) // 4) for t in texts]
+    return [len(t) for t in enc.encode_ordinary_batch(texts)] if texts else []
+
+
+def _token_split(text: str, separators: list[str], chunk_size: int, overlap: int) -> list[str]:
+    """Token-aware splitter: one batched encode per separator level, then greedy packing with `overlap` tokens."""
+    enc = _get_encoder()
+    if enc is None:
+        return _recursive_split(text, separators, chunk_size * 4, overlap * 4)
+
+    def atoms(piece: str, level: int) -> list[tuple[str, int]]:
+        if level >= len(separators) or not separators[level]:
+            toks = enc.encode_ordinary(piece)
+            return [(enc.decode(toks[i:i + chunk_size]), len(toks[i:i + chunk_size])) for i in range(0, len(toks), chunk_size)]
+        sep = separators[level]
+        parts = piece.split(sep)
+        pieces = [p if i == 0 else sep + p for i, p in enumerate(parts)]
+        out = []
+        for p, toks in zip(pieces, enc.encode_ordinary_batch(pieces)):
+            if len(toks) > chunk_size:
+                out.extend(atoms(p, level + 1))
+            elif p:
+                out.append((p, len(toks)))
+        return out
+
+    if len(enc.encode_ordinary(text)) <= chunk_size:
+        return [text] if text.strip() else []
+    overlap = max(0, min(overlap, chunk_size - 1))
+    chunks = []
+    current = []
+    current_tokens = 0
+    for piece, n in atoms(text, 0):
+        if current and current_tokens + n > chunk_size:
+            c = "".join(p for p, _ in current).strip()
+            if c:
+                chunks.append(c)
+            keep = []
+            kept = 0
+            for p, t in reversed(current):
+                if kept + t > overlap:
+                    break
+                keep.insert(0, (p, t))
+                kept += t
+            while keep and kept + n > chunk_size:
+                kept -= keep.pop(0)[1]
+            current, current_tokens = keep, kept
+        current.append((piece, n))
+        current_tokens += n
+    if current:
+        c = "".join(p for p, _ in current).strip()
+        if c:
+            chunks.append(c)
+    return chunks
 
 
 def _recursive_split(text: str, separators: list[str], chunk_size: int, overlap: int, use_tokens: bool = False) -> list[str]:
-    """Recursive splitter (structure-aware). chunk_size in chars or tokens when use_tokens=True."""
-    size_ok = (_token_count(text) <= chunk_size) if use_tokens else (len(text) <= chunk_size)
-    if size_ok:
+    """Recursive splitter (structure-aware). chunk_size in chars, or tokens when use_tokens=True (see _token_split)."""
+    if use_tokens:
+        return _token_split(text, separators, chunk_size, overlap)
+    if len(text) <= chunk_size:
         return [text] if text.strip() else []
-    def fits(a: str, b: str) -> bool:
-        combined = (a + b) if a else b
-        if use_tokens:
-            return _token_count(combined) <= chunk_size
-        return len(combined) <= chunk_size
-
-    def trim_tail(s: str, limit: int) -> str:
-        if use_tokens:
-            try:
-                import tiktoken
-                enc = tiktoken.get_encoding("cl100k_base")
-                toks = enc.encode(s)
-                return enc.decode(toks[-limit:]) if len(toks) > limit else s
-            except Exception:
-                return s[-limit * 4:] if len(s) > limit * 4 else s
-        return s[-limit:] if len(s) > limit else s
-
     sep = separators[0] if separators else ""
     if sep:
         parts = text.split(sep)
@@ -149,33 +212,22 @@ def _recursive_split(text: str, separators: list[str], chunk_size: int, overlap:
         current = ""
         for i, p in enumerate(parts):
             add = p if i == 0 else sep + p
-            if fits(current, add):
+            if len(current + add) <= chunk_size:
                 current = (current + add) if current else add
             else:
                 if current.strip():
                     chunks.append(current.strip())
-                if use_tokens and _token_count(add) > chunk_size and len(separators) > 1:
-                    sub = _recursive_split(add, separators[1:], chunk_size, overlap, use_tokens=True)
-                    chunks.extend(sub[:-1] if sub else [])
-                    current = sub[-1] if sub else trim_tail(add, chunk_size - overlap)
-                elif not use_tokens and len(add) > chunk_size and len(separators) > 1:
-                    sub = _recursive_split(add, separators[1:], chunk_size, overlap, use_tokens=False)
+                if len(add) > chunk_size and len(separators) > 1:
+                    sub = _recursive_split(add, separators[1:], chunk_size, overlap)
                     chunks.extend(sub[:-1] if sub else [])
                     current = sub[-1] if sub else add[-chunk_size:]
                 else:
-                    current = trim_tail(add, chunk_size - overlap) if (use_tokens and _token_count(add) > chunk_size - overlap) or (not use_tokens and len(add) > chunk_size - overlap) else add
+                    limit = chunk_size - overlap
+                    current = add[-limit:] if len(add) > limit else add
         if current.strip():
             chunks.append(current.strip())
         return chunks
     step = chunk_size - overlap
-    if use_tokens:
-        try:
-            import tiktoken
-            enc = tiktoken.get_encoding("cl100k_base")
-            toks = enc.encode(text)
-            return [enc.decode(toks[i:i + chunk_size]) for i in range(0, len(toks), step)]
-        except Exception:
-            return [text[i:i + chunk_size * 4] for i in range(0, len(text), step * 4)]
     return [text[i:i + chunk_size] for i in range(0, len(text), step)]
 
 
@@ -186,30 +238,38 @@ def _semantic_split(text: str, chunk_size_tokens: int, overlap_ratio: float) ->
         return [text.strip()] if text.strip() else []
     overlap_tokens = int(chunk_size_tokens * overlap_ratio)
     chunks = []
-    current = []
+    current = []  # (paragraph, token count): each paragraph is encoded once
     current_tokens = 0
-    for p in paras:
-        n = _token_count(p)
+    for p, n in zip(paras, _token_counts(paras)):
         if current_tokens + n > chunk_size_tokens and current:
-            chunk_text = "\n\n".join(current).strip()
+            chunk_text = "\n\n".join(s for s, _ in current).strip()
             if chunk_text:
                 chunks.append(chunk_text)
             overlap_paras = []
             overlap_t = 0
-            for s in reversed(current):
-                overlap_t += _token_count(s)
-                overlap_paras.insert(0, s)
+            for s, t in reversed(current):
+                overlap_t += t
+                overlap_paras.insert(0, (s, t))
                 if overlap_t >= overlap_tokens:
                     break
             current = overlap_paras
             current_tokens = overlap_t
-        current.append(p)
+        current.append((p, n))
         current_tokens += n
     if current:
-        chunks.append("\n\n".join(current).strip())
+        chunks.append("\n\n".join(s for s, _ in current).strip())
     return [c for c in chunks if c]
 
 
+def path_segments(source: str, depth: int = PATH_DEPTH) -> dict:
+    """Directory prefixes of a source path as {dir_1: "/home", dir_2: "/home/me", ...} (at most `depth` levels)."""
+    parts = Path(source).parts
+    segs = {}
+    for k in range(1, min(depth, len(parts) - 2) + 1):
+        segs[f"dir_{k}"] = str(Path(*parts[:k + 1]))
+    return segs
+
+
 def chunk_text(
     text: str,
     source: str,
@@ -220,9 +280,11 @@ def chunk_text(
     chunk_overlap: int | None = None,
     use_tokens: bool = False,
     semantic: bool = False,
+    path_depth: int = 0,
 ) -> list[dict]:
     """Recursive or semantic chunking with metadata tags per RAG best practices."""
     chunks = []
+    segments = path_segments(source, path_depth) if path_depth > 0 else {}
     size = chunk_size or (CHUNK_SIZE_TOKENS if use_tokens else CHUNK_SIZE)
     overlap_val = chunk_overlap if chunk_overlap is not None else int(size * CHUNK_OVERLAP_RATIO)
     if semantic:
@@ -238,7 +300,7 @@ def chunk_text(
         if section:
             tags += f" [section: {section}]"
         header = tags + "\n---\n"
-        meta = {"source": source, "file_type": file_type, "chunk_id": i}
+        meta = {"source": source, "file_type": file_type, "chunk_id": i, **segments}
         if page is not None:
             meta["page"] = page
         if section:
@@ -250,116 +312,789 @@ def chunk_text(
     return chunks
 
 
+# --- HTTP sessions (one keep-alive pool per upstream) ---
+# Connections kept per upstream; raise for `serve` under concurrent load
+OLLAMA_POOL_SIZE = int(os.environ.get("RAG_OLLAMA_POOL_SIZE", "16"))
+JINA_POOL_SIZE = int(os.environ.get("RAG_JINA_POOL_SIZE", "8"))
+WEB_POOL_SIZE = int(os.environ.get("RAG_WEB_POOL_SIZE", "8"))       # Per host, for direct page fetches
+
+_http_sessions: dict = {}
+_http_lock = threading.Lock()
+
+
+def http_session(upstream: str, pool_size: int, headers: dict | None = None):
+    """Process-wide keep-alive requests.Session for one upstream (created on first use)."""
+    with _http_lock:
+        s = _http_sessions.get(upstream)
+        if s is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            s = requests.Session()
+            s.headers.update(headers or {})
+            s.mount("http://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            s.mount("https://", HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+            _http_sessions[upstream] = s
+        return s
+
+
+def _ollama_session():
+    return http_session("ollama", OLLAMA_POOL_SIZE)
+
+
+def _jina_session():
+    return http_session("jina", JINA_POOL_SIZE, {"User-Agent": "RAG-Research/1.0"})
+
+
+def _web_session():
+    return http_session("web", WEB_POOL_SIZE, {"User-Agent": "RAG-Research/1.0"})
+
+
 # --- Embeddings & Ollama ---
+EMBED_MAX_CHARS = 8000
+EMBED_BATCH_SIZE = 32     # Texts per /api/embed request
+EMBED_CONCURRENCY = 4     # Batches in flight
+EMBED_RETRIES = 3
+EMBED_BACKOFF = 0.5       # Seconds, doubled per retry
+
+
+def _ollama_embed_one(text: str, model: str) -> list[float]:
+    r = _ollama_session().post(
+        f"{OLLAMA_URL}/api/embeddings",
+        json={"model": model, "prompt": text[:EMBED_MAX_CHARS]},
+        timeout=60,
+    )
+    r.raise_for_status()
+    return r.json()["embedding"]
+
+
 def get_ollama_embedding(text: str, model: str = "nomic-embed-text") -> list[float]:
-    import requests
     try:
-        r = requests.post(
-            f"{OLLAMA_URL}/api/embeddings",
-            json={"model": model, "prompt": text[:8000]},
-            timeout=60,
-        )
-        r.raise_for_status()
-        return r.json()["embedding"]
+        return _ollama_embed_one(text, model)
     except Exception:
         if model != "all-minilm":
             return get_ollama_embedding(text, model="all-minilm")
         raise
 
 
-def ollama_chat(messages: list[dict], model: str = "llama3.2") -> str:
-    import requests
-    r = requests.post(
-        f"{OLLAMA_URL}/api/chat",
-        json={"model": model, "messages": messages, "stream": False},
+def _embed_batch_once(texts: list[str], model: str) -> list[list[float]]:
+    """One /api/embed call for a list of texts; falls back to per-text /api/embeddings on old Ollama (404)."""
+    r = _ollama_session().post(
+        f"{OLLAMA_URL}/api/embed",
+        json={"model": model, "input": [t[:EMBED_MAX_CHARS] for t in texts]},
         timeout=120,
     )
+    if r.status_code == 404 and "model" not in r.text.lower():
+        return [_ollama_embed_one(t, model) for t in texts]
     r.raise_for_status()
-    return r.json()["message"]["content"]
+    embeddings = r.json()["embeddings"]
+    if len(embeddings) != len(texts):
+        raise ValueError(f"/api/embed returned {len(embeddings)} embeddings for {len(texts)} inputs")
+    return embeddings
+
+
+def embed_batch(texts: list[str], model: str = "nomic-embed-text", cache: "EmbeddingCache | None" = None) -> list[list[float]]:
+    """Embed one batch with retry + backoff (falls back to all-minilm); with `cache`, only uncached texts are sent."""
+    vectors = cache.get_many(model, texts) if cache else [None] * len(texts)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if not missing:
+        return vectors
+    todo = [texts[i] for i in missing]
+    delay = EMBED_BACKOFF
+    for attempt in range(EMBED_RETRIES):
+        try:
+            fresh = _embed_batch_once(todo, model)
+            break
+        except Exception as e:
+            if attempt == EMBED_RETRIES - 1:
+                if model != "all-minilm":
+                    log("embed_fallback", {"model": model, "error": str(e)})
+                    return embed_batch(texts, model="all-minilm", cache=cache)
+                raise
+            time.sleep(delay)
+            delay *= 2
+    if cache:
+        cache.put_many(model, todo, fresh)
+    for i, v in zip(missing, fresh):
+        vectors[i] = v
+    return vectors
+
+
+def embed_query(text: str, model: str = "nomic-embed-text") -> list[float]:
+    """Query-time embedding through the shared embedding cache."""
+    return embed_batch([text], model, cache=embedding_cache())[0]
+
+
+def embed_texts(
+    texts,
+    model: str = "nomic-embed-text",
+    batch_size: int = EMBED_BATCH_SIZE,
+    concurrency: int = EMBED_CONCURRENCY,
+    progress: bool = True,
+    total: int | None = None,
+    cache: "EmbeddingCache | None" = None,
+):
+    """Yield embeddings for `texts` in input order, `batch_size` per request with at most `concurrency` in flight."""
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor
+
+    def batches():
+        batch = []
+        for t in texts:
+            batch.append(t)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    total = total if total is not None else (len(texts) if hasattr(texts, "__len__") else None)
+    done = 0
+    t0 = time.time()
+
+    def report():
+        if not progress:
+            return
+        elapsed = max(time.time() - t0, 1e-6)
+        of = f"/{total}" if total is not None else ""
+        print(f"\r  Embedded {done}{of} chunks ({done / elapsed:.1f} chunks/s)", end="", flush=True)
+
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        pending = deque()
+        for batch in batches():
+            pending.append(pool.submit(embed_batch, batch, model, cache))
+            if len(pending) >= max(1, concurrency):
+                out = pending.popleft().result()
+                done += len(out)
+                report()
+                yield from out
+        while pending:
+            out = pending.popleft().result()
+            done += len(out)
+            report()
+            yield from out
+    elapsed = time.time() - t0
+    if done:
+        if progress:
+            print()
+        log("embed", {"chunks": done, "seconds": round(elapsed, 3), "chunks_per_s": round(done / max(elapsed, 1e-6), 1)})
+
+
+def ollama_chat(messages: list[dict], model: str = "llama3.2", on_token=None, stats: dict | None = None, num_ctx: int = 0) -> str:
+    """Chat completion; streams deltas to `on_token` if given, fills `stats` and sends `num_ctx` when > 0."""
+    t0 = time.time()
+    payload = {"model": model, "messages": messages, "stream": on_token is not None}
+    if num_ctx > 0:
+        payload["options"] = {"num_ctx": num_ctx}
+    ttft = None
+    parts = []
+    if on_token is None:
+        r = _ollama_session().post(f"{OLLAMA_URL}/api/chat", json=payload, timeout=120)
+        r.raise_for_status()
+        data = r.json()
+        answer = data["message"]["content"]
+    else:
+        data = {}
+        with _ollama_session().post(f"{OLLAMA_URL}/api/chat", json=payload, timeout=120, stream=True) as r:
+            r.raise_for_status()
+            for line in r.iter_lines():
+                if not line:
+                    continue
+                data = json.loads(line)
+                if data.get("error"):
+                    raise RuntimeError(data["error"])
+                delta = (data.get("message") or {}).get("content") or ""
+                if delta:
+                    if ttft is None:
+                        ttft = time.time() - t0
+                    parts.append(delta)
+                    on_token(delta)
+                if data.get("done"):
+                    break
+        answer = "".join(parts)
+    if stats is not None:
+        total = time.time() - t0
+        tokens = data.get("eval_count") or len(parts)
+        gen_s = data["eval_duration"] / 1e9 if data.get("eval_duration") else total - (ttft or 0)
+        stats.update({
+            "ttft_ms": round((ttft if ttft is not None else total) * 1000, 1),
+            "tokens": tokens,
+            "tokens_per_s": round(tokens / gen_s, 1) if tokens and gen_s > 0 else 0.0,
+        })
+    return answer
+
+
+# --- Embedding cache (content-addressed) ---
+EMBED_CACHE_PATH = DEFAULT_CACHE_DIR / "embeddings.sqlite"
+EMBED_CACHE_ENABLED = os.environ.get("RAG_EMBED_CACHE", "true").lower() in ("1", "true", "yes")
+EMBED_CACHE_MAX_MB = int(os.environ.get("RAG_EMBED_CACHE_MAX_MB", "1024"))
+
+
+class EmbeddingCache:
+    """LRU-bounded SQLite cache of float32 embeddings keyed by sha256(model, text)."""
+
+    def __init__(self, path: Path = EMBED_CACHE_PATH, max_bytes: int = EMBED_CACHE_MAX_MB * 1024 * 1024):
+        import sqlite3
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY, vec BLOB NOT NULL, nbytes INTEGER NOT NULL, last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings(last_used);
+            """
+        )
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def key(model: str, text: str) -> str:
+        return hashlib.sha256(f"{model}\0{text[:EMBED_MAX_CHARS]}".encode("utf-8")).hexdigest()
+
+    def get_many(self, model: str, texts: list[str]) -> list[list[float] | None]:
+        from array import array
+        keys = [self.key(model, t) for t in texts]
+        found = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                batch = keys[i:i + 500]
+                marks = ",".join("?" * len(batch))
+                for k, blob in self._db.execute(f"SELECT key, vec FROM embeddings WHERE key IN ({marks})", batch):
+                    found[k] = blob
+            if found:
+                now = time.time()
+                with self._db:
+                    self._db.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?", [(now, k) for k in found])
+            self.hits += sum(1 for k in keys if k in found)
+            self.misses += sum(1 for k in keys if k not in found)
+        out = []
+        for k in keys:
+            blob = found.get(k)
+            if blob is None:
+                out.append(None)
+            else:
+                vec = array("f")
+                vec.frombytes(blob)
+                out.append(vec.tolist())
+        return out
+
+    def put_many(self, model: str, texts: list[str], vectors: list[list[float]]):
+        from array import array
+        now = time.time()
+        rows = []
+        for t, v in zip(texts, vectors):
+            blob = array("f", v).tobytes()
+            rows.append((self.key(model, t), blob, len(blob), now))
+        with self._lock:
+            with self._db:
+                before = self._db.total_changes
+                self._db.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, vec, nbytes, last_used) VALUES (?, ?, ?, ?)", rows
+                )
+                added = self._db.total_changes - before
+            if added and rows:
+                self._bytes += added * rows[0][2]
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop least recently used entries until under 90% of max_bytes (caller holds the lock)."""
+        n, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()
+        target = int(self.max_bytes * 0.9)
+        if n and total > target:
+            drop = int((total - target) / (total / n)) + 1
+            with self._db:
+                self._db.execute(
+                    "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY last_used LIMIT ?)", (drop,)
+                )
+            log("embed_cache_evict", {"evicted": drop, "bytes_before": total})
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            "entries": entries,
+            "bytes": self._bytes,
+        }
+
+
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+
+
+def embedding_cache() -> EmbeddingCache | None:
+    """Process-wide EmbeddingCache, or None when disabled (RAG_EMBED_CACHE=0) or unavailable."""
+    global _embedding_cache
+    if not EMBED_CACHE_ENABLED:
+        return None
+    with _embedding_cache_lock:
+        if _embedding_cache is None:
+            try:
+                _embedding_cache = EmbeddingCache()
+            except Exception as e:
+                log("embed_cache_error", {"error": str(e)})
+                return None
+    return _embedding_cache
 
 
 # --- Hybrid retrieval (BM25 + vector) ---
+RETRIEVAL_WORKERS = int(os.environ.get("RAG_RETRIEVAL_WORKERS", "8"))   # Threads for BM25 scoring and overlapped query expansion
+
+_retrieval_pool = None
+_retrieval_pool_lock = threading.Lock()
+
+
+def _retrieval_executor():
+    """Process-wide pool for BM25 scoring and query expansion alongside the vector query (tasks never wait on other tasks)."""
+    global _retrieval_pool
+    with _retrieval_pool_lock:
+        if _retrieval_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _retrieval_pool = ThreadPoolExecutor(max_workers=RETRIEVAL_WORKERS, thread_name_prefix="rag-retrieval")
+    return _retrieval_pool
+
+
 def bm25_search(corpus: list[str], query: str, top_k: int = TOP_K_RETRIEVE) -> list[int]:
-    from rank_bm25 import BM25Okapi
-    tokenized = [doc.lower().split() for doc in corpus]
-    bm25 = BM25Okapi(tokenized)
-    scores = bm25.get_scores(query.lower().split())
-    return sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k]
+    return bm25_search_many(corpus, [query], top_k)[0]
+
+
+def bm25_search_many(corpus: list[str], queries: list[str], top_k: int = TOP_K_RETRIEVE) -> list[list[int]]:
+    """bm25_search for several queries over one BM25Okapi build of the corpus."""
+    return bm25_rank(bm25_build(corpus), queries, top_k)
 
 
-def reciprocal_rank_fusion(vector_ids: list, bm25_ids: list, k: int = 60) -> list:
-    """Fuse rankings with RRF (Reciprocal Rank Fusion)."""
+def bm25_build(corpus: list[str]):
+    """BM25Okapi over the corpus (same tokenization as bm25_search)."""
+    from rank_bm25 import BM25Okapi
+    return BM25Okapi([doc.lower().split() for doc in corpus])
+
+
+def bm25_rank(bm25, queries: list[str], top_k: int = TOP_K_RETRIEVE) -> list[list[int]]:
+    """Top-k document indices per query from a bm25_build index."""
+    out = []
+    for query in queries:
+        scores = bm25.get_scores(query.lower().split())
+        out.append(sorted(range(len(scores)), key=lambda i: scores[i], reverse=True)[:top_k])
+    return out
+
+
+# --- Persistent BM25 inverted index ---
+BM25_K1 = 1.5
+BM25_B = 0.75
+BM25_INDEX_FILE = ".bm25.sqlite"
+
+
+def _bm25_tokenize(text: str) -> list[str]:
+    """Same tokenizer as bm25_search (lowercase, whitespace split)."""
+    return text.lower().split()
+
+
+def query_filters(filter_source: str | None, filter_type: str | None) -> dict:
+    """Normalize --filter-source/--filter-type into a filter dict shared by Chroma and the BM25 index."""
+    filters = {}
+    if filter_source:
+        filters["source_prefix"] = filter_source
+    if filter_type:
+        filters["file_type"] = filter_type
+    return filters
+
+
+def source_prefix_where(prefix: str, sources: list[str], path_depth: int = 0) -> dict:
+    """Compile a source path prefix into dir_k / source equality and $in predicates (Chroma has no prefix operator)."""
+    import bisect
+    lo = bisect.bisect_left(sources, prefix)
+    hi = bisect.bisect_left(sources, prefix + "\U0010ffff")
+    dirs, files = {}, []
+    for src in sources[lo:hi]:
+        parts = Path(src).parts
+        for k in range(1, min(path_depth, len(parts) - 2) + 1):
+            d = str(Path(*parts[:k + 1]))
+            if (d + os.sep).startswith(prefix):
+                dirs.setdefault(k, set()).add(d)
+                break
+        else:
+            files.append(src)
+    clauses = []
+    for k, ds in sorted(dirs.items()):
+        clauses.append({f"dir_{k}": ds.pop()} if len(ds) == 1 else {f"dir_{k}": {"$in": sorted(ds)}})
+    if files:
+        clauses.append({"source": files[0]} if len(files) == 1 else {"source": {"$in": files}})
+    if not clauses:
+        return {"source": prefix}  # nothing indexed under the prefix: matches only an exact (unindexed) path
+    return clauses[0] if len(clauses) == 1 else {"$or": clauses}
+
+
+def chroma_where(filters: dict | None, sources: list[str] | None = None, path_depth: int = 0) -> dict | None:
+    """Compile query_filters() output into a Chroma `where` clause (indexed sources needed for source_prefix)."""
+    if not filters:
+        return None
+    clauses = []
+    if filters.get("source_prefix"):
+        clauses.append(source_prefix_where(filters["source_prefix"], sources or [], path_depth))
+    if filters.get("file_type"):
+        clauses.append({"file_type": filters["file_type"]})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+
+class SparseIndex:
+    """BM25 inverted index (term postings + doc lengths) in SQLite next to .manifest.json."""
+
+    def __init__(self, index_dir: Path):
+        import sqlite3
+        self.path = Path(index_dir) / BM25_INDEX_FILE
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS docs (
+                id TEXT PRIMARY KEY, source TEXT NOT NULL, file_type TEXT, length INTEGER NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS postings (
+                term TEXT NOT NULL, doc_id TEXT NOT NULL, tf INTEGER NOT NULL,
+                PRIMARY KEY (term, doc_id)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS postings_doc ON postings(doc_id);
+            CREATE INDEX IF NOT EXISTS docs_source ON docs(source);
+            CREATE INDEX IF NOT EXISTS docs_type ON docs(file_type);
+            """
+        )
+
+    @classmethod
+    def open_existing(cls, index_dir: Path) -> "SparseIndex | None":
+        """Open the index only if `rag index` has built it; None means fall back to bm25_search."""
+        if not (Path(index_dir) / BM25_INDEX_FILE).exists():
+            return None
+        try:
+            return cls(index_dir)
+        except Exception as e:
+            log("bm25_index_error", {"error": str(e)})
+            return None
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM docs").fetchone()[0]
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM postings")
+            self._db.execute("DELETE FROM docs")
+
+    def _delete_ids(self, ids: list[str]):
+        for i in range(0, len(ids), 500):
+            batch = ids[i:i + 500]
+            marks = ",".join("?" * len(batch))
+            self._db.execute(f"DELETE FROM postings WHERE doc_id IN ({marks})", batch)
+            self._db.execute(f"DELETE FROM docs WHERE id IN ({marks})", batch)
+
+    def delete_ids(self, ids: list[str]):
+        """Remove individual chunks (chunk-level incremental reindex)."""
+        with self._lock, self._db:
+            self._delete_ids(list(ids))
+
+    def delete_source(self, source: str):
+        """Remove all chunks of one source file (incremental reindex)."""
+        with self._lock, self._db:
+            ids = [r[0] for r in self._db.execute("SELECT id FROM docs WHERE source = ?", (source,))]
+            self._delete_ids(ids)
+
+    def add(self, ids: list[str], contents: list[str], metadatas: list[dict]):
+        """Add or replace chunks. Re-adding an id replaces its postings."""
+        with self._lock, self._db:
+            self._delete_ids(list(ids))
+            for doc_id, text, meta in zip(ids, contents, metadatas):
+                tf = {}
+                for tok in _bm25_tokenize(text):
+                    tf[tok] = tf.get(tok, 0) + 1
+                self._db.execute(
+                    "INSERT OR REPLACE INTO docs (id, source, file_type, length) VALUES (?, ?, ?, ?)",
+                    (doc_id, meta.get("source", ""), meta.get("file_type"), sum(tf.values())),
+                )
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO postings (term, doc_id, tf) VALUES (?, ?, ?)",
+                    [(t, doc_id, n) for t, n in tf.items()],
+                )
+
+    @staticmethod
+    def _filter_sql(filters: dict | None) -> tuple[str, list]:
+        clauses, params = [], []
+        filters = filters or {}
+        if filters.get("source_prefix"):
+            # Range form of "starts with" so SQLite can use docs_source
+            prefix = filters["source_prefix"]
+            clauses.append("d.source >= ? AND d.source < ?")
+            params.extend([prefix, prefix + "\U0010ffff"])
+        if filters.get("file_type"):
+            clauses.append("d.file_type = ?")
+            params.append(filters["file_type"])
+        return (" AND ".join(clauses) if clauses else "1"), params
+
+    def search(self, query: str, top_k: int = TOP_K_RETRIEVE, filters: dict | None = None) -> list[str]:
+        """BM25 (Okapi) top-k doc ids. Corpus statistics are computed over the filtered subset, like bm25_search."""
+        q_tf = {}
+        for tok in _bm25_tokenize(query):
+            q_tf[tok] = q_tf.get(tok, 0) + 1
+        if not q_tf:
+            return []
+        cond, params = self._filter_sql(filters)
+        with self._lock:
+            n_docs, total_len = self._db.execute(
+                f"SELECT COUNT(*), COALESCE(SUM(d.length), 0) FROM docs d WHERE {cond}", params
+            ).fetchone()
+            if not n_docs:
+                return []
+            terms = list(q_tf)
+            marks = ",".join("?" * len(terms))
+            rows = self._db.execute(
+                f"SELECT p.term, p.doc_id, p.tf, d.length FROM postings p JOIN docs d ON d.id = p.doc_id "
+                f"WHERE p.term IN ({marks}) AND {cond}",
+                terms + params,
+            ).fetchall()
+        import math
+        avgdl = total_len / n_docs if n_docs else 1.0
+        postings = {}
+        for term, doc_id, tf, length in rows:
+            postings.setdefault(term, []).append((doc_id, tf, length))
+        scores = {}
+        for term, plist in postings.items():
+            df = len(plist)
+            idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+            for doc_id, tf, length in plist:
+                denom = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / (avgdl or 1.0))
+                scores[doc_id] = scores.get(doc_id, 0.0) + q_tf[term] * idf * tf * (BM25_K1 + 1) / denom
+        return sorted(scores, key=lambda i: scores[i], reverse=True)[:top_k]
+
+
+def reciprocal_rank_fusion(*rankings: list, k: int = 60) -> list:
+    """Fuse rankings (e.g. vector ids, BM25 ids) with RRF (Reciprocal Rank Fusion)."""
     scores = {}
-    for rank, doc_id in enumerate(vector_ids):
-        scores[doc_id] = scores.get(doc_id, 0) + 1 / (k + rank + 1)
-    for rank, doc_id in enumerate(bm25_ids):
-        scores[doc_id] = scores.get(doc_id, 0) + 1 / (k + rank + 1)
+    for ranking in rankings:
+        for rank, doc_id in enumerate(ranking):
+            scores[doc_id] = scores.get(doc_id, 0) + 1 / (k + rank + 1)
     return sorted(scores.keys(), key=lambda i: scores[i], reverse=True)[:TOP_K_RETRIEVE]
 
 
-def _rerank_cross_encoder(query: str, docs: list[str], top_k: int = TOP_K_RERANK) -> list[str]:
+# --- Reranker (process-wide registry) ---
+RERANK_BATCH_SIZE = int(os.environ.get("RAG_RERANK_BATCH_SIZE", "16"))        # Pairs per CrossEncoder.predict batch
+RERANK_MAX_LENGTH = int(os.environ.get("RAG_RERANK_MAX_LENGTH", "256"))       # Model tokens per (query, doc) pair
+RERANK_MAX_CHARS = int(os.environ.get("RAG_RERANK_MAX_CHARS", "1500"))        # Candidate text truncated before scoring
+RERANK_MAX_CANDIDATES = int(os.environ.get("RAG_RERANK_MAX_CANDIDATES", str(TOP_K_RETRIEVE)))
+RERANK_CACHE_SIZE = int(os.environ.get("RAG_RERANK_CACHE_SIZE", "4096"))      # (query, chunk id) scores kept in memory
+
+
+class LRUCache:
+    """Thread-safe in-memory LRU bounded by entry count and optional `max_bytes` / `ttl`; `get` returns None on miss."""
+
+    def __init__(self, max_entries: int, max_bytes: int = 0, ttl: float = 0):
+        from collections import OrderedDict
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes = 0
+        self._data = OrderedDict()  # key -> (value, ts, nbytes)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if self.ttl and time.time() - item[1] >= self.ttl:
+                self._drop(key)
+                return None
+            self._data.move_to_end(key)
+            return item[0]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        nbytes = len(value) if isinstance(value, (str, bytes)) else 0
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (value, time.time(), nbytes)
+            self.bytes += nbytes
+            while self._data and (
+                len(self._data) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes)
+            ):
+                self._drop(next(iter(self._data)))
+
+    def _drop(self, key):
+        """Remove one entry (caller holds the lock)."""
+        self.bytes -= self._data.pop(key)[2]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+_rerankers: dict = {}
+_reranker_lock = threading.Lock()
+_rerank_scores = LRUCache(RERANK_CACHE_SIZE)
+
+
+def _get_reranker(model_name: str = RERANKER_MODEL):
+    """Cross-encoder loaded once per process (concurrent callers share the load), or None if unavailable."""
+    with _reranker_lock:
+        if model_name not in _rerankers:
+            try:
+                from sentence_transformers import CrossEncoder
+                _rerankers[model_name] = CrossEncoder(model_name, max_length=RERANK_MAX_LENGTH)
+            except Exception as e:
+                log("rerank_fallback", {"error": str(e)})
+                _rerankers[model_name] = None
+        return _rerankers[model_name]
+
+
+def prewarm_reranker(model_name: str = RERANKER_MODEL):
+    """Start loading the cross-encoder in the background (overlaps with embedding + vector search)."""
+    if model_name in _rerankers:
+        return
+    threading.Thread(target=_get_reranker, args=(model_name,), daemon=True).start()
+
+
+def _rerank_cross_encoder(
+    query: str, docs: list[str], top_k: int = TOP_K_RERANK,
+    ids: list[str] | None = None, model_name: str = RERANKER_MODEL,
+) -> list[str]:
     """Rerank docs with cross-encoder. Returns top_k by relevance."""
     if not docs:
         return []
-    try:
-        from sentence_transformers import CrossEncoder
-        model = CrossEncoder(RERANKER_MODEL)
-        pairs = [(query, d) for d in docs]
-        scores = model.predict(pairs)
-        ranked = sorted(zip(scores, docs), key=lambda x: x[0], reverse=True)
-        return [d for _, d in ranked[:top_k]]
-    except Exception as e:
-        log("rerank_fallback", {"error": str(e)})
+    docs = docs[:RERANK_MAX_CANDIDATES]
+    ids = list(ids[:len(docs)]) if ids else [chunk_id(d) for d in docs]
+    model = _get_reranker(model_name)
+    if model is None:
         return docs[:top_k]
+    keys = [(model_name, query, i) for i in ids]
+    scores = [_rerank_scores.get(k) for k in keys]
+    todo = [j for j, sc in enumerate(scores) if sc is None]
+    if todo:
+        t0 = time.time()
+        try:
+            pairs = [(query, docs[j][:RERANK_MAX_CHARS]) for j in todo]
+            fresh = model.predict(pairs, batch_size=RERANK_BATCH_SIZE, show_progress_bar=False)
+        except Exception as e:
+            log("rerank_fallback", {"error": str(e)})
+            return docs[:top_k]
+        for j, sc in zip(todo, fresh):
+            scores[j] = float(sc)
+            _rerank_scores.put(keys[j], scores[j])
+        log("rerank", {"scored": len(todo), "cached": len(docs) - len(todo), "latency_ms": (time.time() - t0) * 1000})
+    order = sorted(range(len(docs)), key=lambda j: scores[j], reverse=True)
+    return [docs[j] for j in order[:top_k]]
+
+
+def _hybrid_rankings(
+    coll, queries: list[str], embed_model: str, where: dict | None,
+    sparse: SparseIndex | None = None, filters: dict | None = None, corpus: dict | None = None,
+) -> tuple[list[list[str]], dict]:
+    """RRF-fused id ranking per query and the id -> document map; without `sparse`, BM25Okapi is built once into `corpus`."""
+    corpus = {} if corpus is None else corpus
+
+    def lexical() -> tuple[list, dict]:
+        if sparse is not None:
+            with span("bm25"):
+                return [sparse.search(q, TOP_K_RETRIEVE, filters) for q in queries], {}
+        fresh = "ids" not in corpus
+        if fresh:
+            with span("corpus_fetch"):
+                all_data = coll.get(include=["documents"], where=where)
+            corpus["ids"], corpus["docs"] = all_data["ids"] or [], all_data["documents"] or []
+            with span("bm25"):
+                corpus["bm25"] = bm25_build(corpus["docs"]) if corpus["docs"] else None
+        all_ids = corpus["ids"]
+        with span("bm25"):
+            ranked = bm25_rank(corpus["bm25"], queries, TOP_K_RETRIEVE) if corpus["bm25"] else [[] for _ in queries]
+        return [[all_ids[i] for i in r] for r in ranked], dict(zip(all_ids, corpus["docs"])) if fresh else {}
+
+    lexical_future = _retrieval_executor().submit(contextvars.copy_context().run, lexical)
+    with span("embed_query"):
+        query_embs = embed_batch(queries, embed_model, cache=embedding_cache())
+    with span("vector_search"):
+        q = coll.query(
+            query_embeddings=query_embs,
+            n_results=TOP_K_RETRIEVE,
+            include=["documents"],  # ids are always returned
+            where=where,
+        )
+    bm25_ids, id_to_doc = lexical_future.result()
+    rankings = []
+    with span("rrf"):
+        for i in range(len(queries)):
+            vec_ids = q["ids"][i] if q["ids"] else []
+            id_to_doc.update(zip(vec_ids, q["documents"][i] if q["documents"] else []))
+            rankings.append(reciprocal_rank_fusion(vec_ids, bm25_ids[i]))
+    return rankings, id_to_doc
+
+
+def _select_docs(coll, query: str, fused_ids: list[str], id_to_doc: dict, use_rerank: bool) -> list[str]:
+    """Documents for a fused ranking: fetch ids not seen yet, then rerank or keep the top TOP_K_FINAL."""
+    missing = [i for i in fused_ids if i not in id_to_doc]
+    if missing:
+        with span("corpus_fetch"):
+            got = coll.get(ids=missing, include=["documents"])
+        id_to_doc.update(zip(got["ids"] or [], got["documents"] or []))
+    cand_ids = [i for i in fused_ids if i in id_to_doc]
+    candidates = [id_to_doc[i] for i in cand_ids]
+    if use_rerank and len(candidates) > TOP_K_RERANK:
+        with span("rerank"):
+            return _rerank_cross_encoder(query, candidates, TOP_K_RERANK, ids=cand_ids)
+    return candidates[:TOP_K_FINAL]
 
 
-def retrieve_hybrid(coll, query: str, embed_model: str, where: dict | None, use_rerank: bool = True) -> list[str]:
+def retrieve_hybrid(
+    coll, query: str, embed_model: str, where: dict | None, use_rerank: bool = True,
+    sparse: SparseIndex | None = None, filters: dict | None = None,
+) -> list[str]:
     """Run hybrid (BM25 + vector) retrieval; return top documents."""
-    query_emb = get_ollama_embedding(query, embed_model)
-    q = coll.query(
-        query_embeddings=[query_emb],
-        n_results=TOP_K_RETRIEVE,
-        include=["documents", "ids"],
-        where=where,
-    )
-    vec_docs = q["documents"][0] if q["documents"] else []
-    vec_ids = q["ids"][0] if q["ids"] else []
-    all_data = coll.get(include=["documents"], where=where)
-    all_docs = all_data["documents"] or []
-    all_ids = all_data["ids"] or []
-    id_to_doc = dict(zip(all_ids, all_docs))
-    bm25_indices = bm25_search(all_docs, query, TOP_K_RETRIEVE) if all_docs else []
-    bm25_ids = [all_ids[i] for i in bm25_indices]
-    fused_ids = reciprocal_rank_fusion(vec_ids, bm25_ids)
-    candidates = [id_to_doc[i] for i in fused_ids if i in id_to_doc]
-    if use_rerank and len(candidates) > TOP_K_RERANK:
-        return _rerank_cross_encoder(query, candidates, TOP_K_RERANK)
-    return candidates[:TOP_K_FINAL]
+    rankings, id_to_doc = _hybrid_rankings(coll, [query], embed_model, where, sparse, filters)
+    return _select_docs(coll, query, rankings[0], id_to_doc, use_rerank)
+
+
+EXPAND_OVERLAP = os.environ.get("RAG_EXPAND_OVERLAP", "true").lower() in ("1", "true", "yes")
 
 
 def retrieve_with_expansion(
     coll, query: str, embed_model: str, where: dict | None, use_rerank: bool,
     expand_query_fn=None, model: str = "llama3.2",
+    sparse: SparseIndex | None = None, filters: dict | None = None,
 ) -> list[str]:
-    """Retrieve with optional query expansion. Expands query, retrieves per variant, fuses with RRF."""
+    """Retrieve with optional query expansion. Expands query, retrieves all variants in one pass, fuses with RRF."""
     if not expand_query_fn:
-        return retrieve_hybrid(coll, query, embed_model, where, use_rerank)
-    queries = expand_query(query, model, num_alternatives=2)
-    all_ranked = []
-    for q in queries:
-        docs = retrieve_hybrid(coll, q, embed_model, where, use_rerank=False)
-        all_ranked.append([(d, i) for i, d in enumerate(docs)])
-    if len(all_ranked) == 1:
-        return retrieve_hybrid(coll, query, embed_model, where, use_rerank)
-    doc_to_score = {}
-    for rank_list in all_ranked:
-        for doc, rank in rank_list:
-            doc_str = doc
-            doc_to_score[doc_str] = doc_to_score.get(doc_str, 0) + 1 / (60 + rank + 1)
-    merged = sorted(doc_to_score.keys(), key=lambda d: doc_to_score[d], reverse=True)[:TOP_K_RETRIEVE]
-    if use_rerank and len(merged) > TOP_K_RERANK:
-        return _rerank_cross_encoder(query, merged, TOP_K_RERANK)
-    return merged[:TOP_K_FINAL]
+        return retrieve_hybrid(coll, query, embed_model, where, use_rerank, sparse, filters)
+
+    def expand() -> list[str]:
+        with span("expand_query"):
+            return [q for q in expand_query_fn(query, model, num_alternatives=2) if q != query]
+
+    if EXPAND_OVERLAP:
+        pending = _retrieval_executor().submit(contextvars.copy_context().run, expand)
+        corpus = {}  # fallback lexical index, shared by both passes
+        rankings, id_to_doc = _hybrid_rankings(coll, [query], embed_model, where, sparse, filters, corpus)
+        alts = pending.result()
+        if alts:
+            more, more_docs = _hybrid_rankings(coll, alts, embed_model, where, sparse, filters, corpus)
+            rankings += more
+            id_to_doc.update(more_docs)
+    else:
+        alts = expand()
+        rankings, id_to_doc = _hybrid_rankings(coll, [query] + alts, embed_model, where, sparse, filters)
+    fused_ids = rankings[0] if len(rankings) == 1 else reciprocal_rank_fusion(*rankings)
+    return _select_docs(coll, query, fused_ids, id_to_doc, use_rerank)
 
 
 def expand_query(query: str, model: str, num_alternatives: int = 2) -> list[str]:
@@ -370,7 +1105,7 @@ def expand_query(query: str, model: str, num_alternatives: int = 2) -> list[str]
 
 Alternatives:"""
         messages = [{"role": "user", "content": prompt}]
-        out = ollama_chat(messages, model)
+        out = ollama_chat(messages, model, num_ctx=NUM_CTX)
         lines = [line.strip() for line in out.strip().split("\n") if line.strip()]
         alts = [q for q in lines[:num_alternatives] if len(q) > 5 and q.lower() != query.lower()]
         return [query] + alts
@@ -395,10 +1130,228 @@ WEB_SNIPPET_MAX = 8
 WEB_FETCH_MAX = 3
 WEB_FETCH_TIMEOUT = 10
 WEB_FETCH_MAX_CHARS = 8000
+WEB_DEADLINE = float(os.environ.get("RAG_WEB_DEADLINE", "20"))       # Seconds for the whole web stage
+WEB_HEDGE_DELAY = float(os.environ.get("RAG_WEB_HEDGE_DELAY", "2"))  # Start direct fetch if Jina is still pending
+WEB_FETCH_WORKERS = 8
+
+_web_pool = None
+_web_pool_lock = threading.Lock()
+_fetch_pool = None
+_fetch_pool_lock = threading.Lock()
+
+
+def _web_executor():
+    """Process-wide pool for the web stage tasks (search, one task per URL), shared across requests."""
+    global _web_pool
+    with _web_pool_lock:
+        if _web_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _web_pool = ThreadPoolExecutor(max_workers=2 * WEB_FETCH_WORKERS, thread_name_prefix="rag-web")
+    return _web_pool
+
+
+def _fetch_executor():
+    """Process-wide pool for individual fetch attempts (Jina / direct); separate because URL tasks wait on them."""
+    global _fetch_pool
+    with _fetch_pool_lock:
+        if _fetch_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _fetch_pool = ThreadPoolExecutor(max_workers=2 * WEB_FETCH_WORKERS, thread_name_prefix="rag-fetch")
+    return _fetch_pool
+
+
+# Persistent page + search cache
+WEB_CACHE_PATH = DEFAULT_CACHE_DIR / "web.sqlite"
+WEB_CACHE_ENABLED = os.environ.get("RAG_WEB_CACHE", "true").lower() in ("1", "true", "yes")
+WEB_CACHE_TTL = int(os.environ.get("RAG_WEB_CACHE_TTL", "86400"))     # Page served without revalidation (s)
+WEB_SEARCH_TTL = int(os.environ.get("RAG_WEB_SEARCH_TTL", "3600"))    # Search result lists (s)
+WEB_CACHE_MAX_MB = int(os.environ.get("RAG_WEB_CACHE_MAX_MB", "256"))
+_TRACKING_PARAMS = ("utm_", "fbclid", "gclid", "mc_cid", "mc_eid")
+
+
+def normalize_url(url: str) -> str:
+    """Cache key for a URL: lowercase scheme/host, no default port, fragment or tracking params, sorted query."""
+    from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+    parts = urlsplit(url.strip())
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    if port and (scheme, port) not in (("http", 80), ("https", 443)):
+        netloc = f"{netloc}:{port}"
+    query = urlencode(sorted(
+        (k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if not k.lower().startswith(_TRACKING_PARAMS)
+    ))
+    return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+class WebCache:
+    """SQLite cache of extracted page text (with ETag/Last-Modified) and web_search results, LRU-bounded by `max_bytes`."""
+
+    def __init__(
+        self, path: Path = WEB_CACHE_PATH, ttl: int = WEB_CACHE_TTL, search_ttl: int = WEB_SEARCH_TTL,
+        max_bytes: int = WEB_CACHE_MAX_MB * 1024 * 1024,
+    ):
+        import sqlite3
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.search_ttl = search_ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.stale = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(self.path), check_same_thread=False, timeout=30)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY, text TEXT NOT NULL, etag TEXT, last_modified TEXT,
+                fetched_at REAL NOT NULL, nbytes INTEGER NOT NULL, last_used REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS pages_lru ON pages(last_used);
+            CREATE TABLE IF NOT EXISTS searches (
+                key TEXT PRIMARY KEY, results TEXT NOT NULL, fetched_at REAL NOT NULL, nbytes INTEGER NOT NULL
+            );
+            """
+        )
+        self._bytes = self._total_bytes()
+
+    def _total_bytes(self) -> int:
+        pages = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM pages").fetchone()[0]
+        searches = self._db.execute("SELECT COALESCE(SUM(nbytes), 0) FROM searches").fetchone()[0]
+        return pages + searches
+
+    def get_page(self, url: str) -> dict | None:
+        """Cached page for a normalized URL: {text, etag, last_modified, fresh}, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT text, etag, last_modified, fetched_at FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with self._db:
+                self._db.execute("UPDATE pages SET last_used = ? WHERE url = ?", (time.time(), url))
+        fresh = time.time() - row[3] < self.ttl
+        if fresh:
+            self.hits += 1
+        else:
+            self.stale += 1
+        return {"text": row[0], "etag": row[1], "last_modified": row[2], "fresh": fresh}
+
+    def put_page(self, url: str, text: str, etag: str | None = None, last_modified: str | None = None):
+        now = time.time()
+        nbytes = len(text.encode("utf-8"))
+        with self._lock:
+            old = self._db.execute("SELECT nbytes FROM pages WHERE url = ?", (url,)).fetchone()
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO pages (url, text, etag, last_modified, fetched_at, nbytes, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (url, text, etag, last_modified, now, nbytes, now),
+                )
+            self._bytes += nbytes - (old[0] if old else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def touch_page(self, url: str):
+        """Mark a page fresh again after a 304 Not Modified."""
+        with self._lock:
+            with self._db:
+                self._db.execute("UPDATE pages SET fetched_at = ? WHERE url = ?", (time.time(), url))
+            self.revalidated += 1
+
+    @staticmethod
+    def search_key(query: str, max_results: int) -> str:
+        return f"{max_results}\0{' '.join(query.lower().split())}"
+
+    def get_search(self, query: str, max_results: int) -> list[dict] | None:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT results, fetched_at FROM searches WHERE key = ?", (self.search_key(query, max_results),)
+            ).fetchone()
+        if row is None or time.time() - row[1] >= self.search_ttl:
+            return None
+        return json.loads(row[0])
+
+    def put_search(self, query: str, max_results: int, results: list[dict]):
+        blob = json.dumps(results)
+        key = self.search_key(query, max_results)
+        nbytes = len(blob.encode("utf-8"))
+        with self._lock:
+            old = self._db.execute("SELECT nbytes FROM searches WHERE key = ?", (key,)).fetchone()
+            with self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO searches (key, results, fetched_at, nbytes) VALUES (?, ?, ?, ?)",
+                    (key, blob, time.time(), nbytes),
+                )
+            self._bytes += nbytes - (old[0] if old else 0)
+            if self._bytes > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        """Drop expired searches, then least recently used pages until under 90% of max_bytes (caller holds the lock)."""
+        total = self._total_bytes()
+        target = int(self.max_bytes * 0.9)
+        if total > target:
+            with self._db:
+                self._db.execute("DELETE FROM searches WHERE fetched_at < ?", (time.time() - self.search_ttl,))
+                excess = self._total_bytes() - target
+                dropped = 0
+                for url, nbytes in self._db.execute("SELECT url, nbytes FROM pages ORDER BY last_used").fetchall():
+                    if excess <= 0:
+                        break
+                    self._db.execute("DELETE FROM pages WHERE url = ?", (url,))
+                    excess -= nbytes
+                    dropped += 1
+            log("web_cache_evict", {"evicted": dropped, "bytes_before": total})
+        self._bytes = self._total_bytes()
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.stale + self.misses
+        with self._lock:
+            pages = self._db.execute("SELECT COUNT(*) FROM pages").fetchone()[0]
+        return {
+            "hits": self.hits,
+            "stale": self.stale,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_rate": round((self.hits + self.revalidated) / lookups, 4) if lookups else 0.0,
+            "pages": pages,
+            "bytes": self._bytes,
+        }
+
+
+_web_cache = None
+_web_cache_lock = threading.Lock()
+
+
+def web_cache() -> WebCache | None:
+    """Process-wide WebCache, or None when disabled (RAG_WEB_CACHE=0) or unavailable."""
+    global _web_cache
+    if not WEB_CACHE_ENABLED:
+        return None
+    with _web_cache_lock:
+        if _web_cache is None:
+            try:
+                _web_cache = WebCache()
+            except Exception as e:
+                log("web_cache_error", {"error": str(e)})
+                return None
+    return _web_cache
 
 
 def web_search(query: str, max_results: int = WEB_SNIPPET_MAX) -> list[dict]:
-    """Search the web via DuckDuckGo; return [{title, href, body}, ...]."""
+    """Search the web via DuckDuckGo; return [{title, href, body}, ...]. Cached for WEB_SEARCH_TTL."""
+    cache = web_cache()
+    if cache:
+        cached = cache.get_search(query, max_results)
+        if cached is not None:
+            return cached
     try:
         from duckduckgo_search import DDGS
         results = []
@@ -409,6 +1362,8 @@ def web_search(query: str, max_results: int = WEB_SNIPPET_MAX) -> list[dict]:
                     "href": r.get("href", ""),
                     "body": r.get("body", ""),
                 })
+        if cache and results:
+            cache.put_search(query, max_results, results)
         return results
     except Exception as e:
         log("web_search_error", {"query": query[:50], "error": str(e)})
@@ -420,14 +1375,9 @@ JINA_READER_BASE = "https://r.jina.ai/"
 
 def _fetch_via_jina(url: str) -> str | None:
     """Fetch URL via Jina Reader for cleaner, LLM-friendly content."""
-    import requests
     jina_url = JINA_READER_BASE + url
     try:
-        r = requests.get(
-            jina_url,
-            timeout=WEB_FETCH_TIMEOUT,
-            headers={"User-Agent": "RAG-Research/1.0", "Accept": "text/markdown"},
-        )
+        r = _jina_session().get(jina_url, timeout=WEB_FETCH_TIMEOUT, headers={"Accept": "text/markdown"})
         r.raise_for_status()
         text = r.text
         if text and len(text.strip()) > 100:
@@ -438,24 +1388,27 @@ def _fetch_via_jina(url: str) -> str | None:
         return None
 
 
-def fetch_url_text(url: str, prefer_jina: bool | None = None) -> str | None:
-    """Fetch URL and extract main text content. Uses Jina Reader when available for cleaner output."""
-    if prefer_jina is None:
-        prefer_jina = os.environ.get("RAG_USE_JINA", "true").lower() in ("1", "true", "yes")
-    import requests
-    if prefer_jina:
-        text = _fetch_via_jina(url)
-        if text:
-            return text
+def _fetch_direct(
+    url: str, etag: str | None = None, last_modified: str | None = None, timeout: float = WEB_FETCH_TIMEOUT,
+) -> tuple[str | None, dict]:
+    """Fetch URL directly (conditional GET with validators) and extract main text. Returns (text, {status, etag, last_modified})."""
+    headers = {}
+    if etag:
+        headers["If-None-Match"] = etag
+    if last_modified:
+        headers["If-Modified-Since"] = last_modified
     try:
-        r = requests.get(url, timeout=WEB_FETCH_TIMEOUT, headers={"User-Agent": "RAG-Research/1.0"})
+        r = _web_session().get(url, timeout=timeout, headers=headers)
+        meta = {"status": r.status_code, "etag": r.headers.get("ETag"), "last_modified": r.headers.get("Last-Modified")}
+        if r.status_code == 304:
+            return None, meta
         r.raise_for_status()
         html = r.text
         try:
             from trafilatura import extract
             result = extract(html)
             if result:
-                return result[:WEB_FETCH_MAX_CHARS]
+                return result[:WEB_FETCH_MAX_CHARS], meta
         except Exception:
             pass
         # Fallback: strip HTML tags crudely
@@ -463,10 +1416,61 @@ def fetch_url_text(url: str, prefer_jina: bool | None = None) -> str | None:
         text = re.sub(r"<style[^>]*>[\s\S]*?</style>", "", text, flags=re.I)
         text = re.sub(r"<[^>]+>", " ", text)
         text = re.sub(r"\s+", " ", text).strip()
-        return text[:WEB_FETCH_MAX_CHARS] if text else None
+        return (text[:WEB_FETCH_MAX_CHARS] if text else None), meta
     except Exception as e:
         log("fetch_url_error", {"url": url[:80], "error": str(e)})
-        return None
+        return None, {}
+
+
+def _fetch_hedged(url: str, prefer_jina: bool, deadline: float) -> tuple[str | None, dict]:
+    """Jina first if enabled; the direct fetch starts when Jina fails or after WEB_HEDGE_DELAY. First non-empty result wins."""
+    if not prefer_jina:
+        return _fetch_direct(url, timeout=max(0.1, min(WEB_FETCH_TIMEOUT, deadline - time.time())))
+    from concurrent.futures import FIRST_COMPLETED, wait
+    pool = _fetch_executor()
+    pending = {pool.submit(lambda: (_fetch_via_jina(url), {}))}
+    hedged = False
+    while pending:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining if hedged else min(remaining, WEB_HEDGE_DELAY), return_when=FIRST_COMPLETED)
+        for f in done:
+            text, meta = f.result()
+            if text:
+                return text, meta
+        if not hedged:
+            pending.add(pool.submit(_fetch_direct, url))
+            hedged = True
+    return None, {}
+
+
+def fetch_url_text(url: str, prefer_jina: bool | None = None, timeout: float | None = None) -> str | None:
+    """Fetch URL and extract main text content. Uses Jina Reader when available for cleaner output."""
+    if prefer_jina is None:
+        prefer_jina = os.environ.get("RAG_USE_JINA", "true").lower() in ("1", "true", "yes")
+    deadline = time.time() + (timeout if timeout is not None else 2 * WEB_FETCH_TIMEOUT)
+    cache = web_cache()
+    key = normalize_url(url)
+    entry = cache.get_page(key) if cache else None
+    if entry and entry["fresh"]:
+        return entry["text"]
+    if entry and (entry["etag"] or entry["last_modified"]):
+        remaining = min(WEB_FETCH_TIMEOUT, deadline - time.time())
+        if remaining > 0:
+            text, meta = _fetch_direct(url, entry["etag"], entry["last_modified"], timeout=remaining)
+            if meta.get("status") == 304:
+                cache.touch_page(key)
+                return entry["text"]
+            if text:
+                cache.put_page(key, text, meta.get("etag"), meta.get("last_modified"))
+                return text
+    text, meta = _fetch_hedged(url, prefer_jina, deadline)
+    if text:
+        if cache:
+            cache.put_page(key, text, meta.get("etag"), meta.get("last_modified"))
+        return text
+    return entry["text"] if entry else None
 
 
 URL_RE = re.compile(r"https?://[^\s\)\]\"']+", re.I)
@@ -477,63 +1481,353 @@ def _extract_urls(text: str) -> list[str]:
     return list(dict.fromkeys(URL_RE.findall(text)))  # unique, order preserved
 
 
-def build_web_context(query: str) -> str:
-    """Search web and optionally fetch top URLs; return formatted context string."""
-    parts = []
+def web_context_parts(query: str, deadline: float = WEB_DEADLINE) -> list[tuple[str, str, str]]:
+    """Search web and fetch top URLs within `deadline` seconds; return (url, title, text) parts in ranking order."""
+    from concurrent.futures import wait
+    from urllib.parse import urlparse
+    t0 = time.time()
+    end = t0 + deadline
+    pool = _web_executor()
+
+    def fetch_one(url: str):
+        with span("url_fetch"):
+            return fetch_url_text(url, timeout=max(0.0, end - time.time()))
+
+    def fetch(url: str):
+        return pool.submit(contextvars.copy_context().run, fetch_one, url)
+
+    def search():
+        with span("web_search"):
+            return web_search(query, max_results=WEB_SNIPPET_MAX)
+
+    slots = []  # (url, title, future | None, snippet, is_user_url)
     seen_urls = set()
+    futures = []
+    not_done = set()
+    try:
+        # 1. If query contains URLs, fetch them directly (user-provided URLs get priority)
+        for url in _extract_urls(query):
+            url = url.rstrip(".,;:!?)")
+            if url not in seen_urls:
+                seen_urls.add(url)
+                slots.append((url, urlparse(url).netloc or url, fetch(url), "", True))
+
+        # 2. DuckDuckGo search for additional context (runs while user URLs download)
+        pending = pool.submit(contextvars.copy_context().run, search)
+        wait([pending], timeout=max(0.0, end - time.time()))
+        if pending.done():
+            results = pending.result()
+        else:
+            pending.cancel()
+            log("web_search_timeout", {"query": query[:50], "deadline_s": deadline})
+            results = []
+        for i, r in enumerate(results):
+            href = r.get("href", "").strip()
+            title = r.get("title", "").strip()
+            if not href or href in seen_urls:
+                continue
+            seen_urls.add(href)
+            future = fetch(href) if i < WEB_FETCH_MAX else None
+            slots.append((href, title, future, r.get("body", "").strip(), False))
+
+        futures = [f for _, _, f, _, _ in slots if f is not None]
+        _, not_done = wait(futures, timeout=max(0.0, end - time.time()))
+    finally:
+        for _, _, f, _, _ in slots:
+            if f is not None:
+                f.cancel()  # late fetches: only still-queued ones stop, running ones finish in the background
 
-    # 1. If query contains URLs, fetch them directly (user-provided URLs get priority)
-    for url in _extract_urls(query):
-        from urllib.parse import urlparse
-        url = url.rstrip(".,;:!?)")
-        if url not in seen_urls:
-            seen_urls.add(url)
-            text = fetch_url_text(url)
-            title = urlparse(url).netloc or url
+    parts = []
+    for url, title, future, snippet, is_user_url in slots:
+        text = future.result() if future is not None and future.done() and not future.cancelled() else None
+        if is_user_url:
             if text and len(text) > 50:
                 parts.append((url, title, text[:4000]))
             elif text:
                 parts.append((url, title, text))
-
-    # 2. DuckDuckGo search for additional context
-    results = web_search(query, max_results=WEB_SNIPPET_MAX)
-    for i, r in enumerate(results):
-        href = r.get("href", "").strip()
-        title = r.get("title", "").strip()
-        if not href or href in seen_urls:
             continue
-        seen_urls.add(href)
-        if i < WEB_FETCH_MAX:
-            text = fetch_url_text(href)
-            if text and len(text) > 200:
-                body = text[:4000]
-            else:
-                body = r.get("body", "").strip()
-        else:
-            body = r.get("body", "").strip()
+        body = text[:4000] if text and len(text) > 200 else snippet
         if body:
-            parts.append((href, title, body))
+            parts.append((url, title, body))
+    log("web_context", {"fetched": len(futures) - len(not_done), "timed_out": len(not_done), "parts": len(parts), "latency_ms": (time.time() - t0) * 1000})
+    return parts
+
 
+def format_web_context(parts: list[tuple[str, str, str]]) -> str:
     return "\n\n---\n\n".join(
         f"[{i}] [url: {href}] [title: {title}]\n{body}" for i, (href, title, body) in enumerate(parts, 1)
     ) if parts else ""
 
 
+# --- Context packing ---
+NUM_CTX = int(os.environ.get("RAG_NUM_CTX", "0"))                    # Ollama num_ctx sent with every chat (0 = model/server setting)
+CONTEXT_TOKENS = int(os.environ.get("RAG_CONTEXT_TOKENS", "0"))      # Cap on packed context tokens (0 = whatever fits num_ctx)
+DEFAULT_NUM_CTX = 2048                                               # Smallest num_ctx sent for a --context-tokens cap (Ollama's default)
+ANSWER_TOKENS = int(os.environ.get("RAG_ANSWER_TOKENS", "512"))      # Room left in num_ctx for the answer
+PACK_MIN_OVERLAP = 24   # Chars a chunk's tail must share with another's head to be merged
+PACK_MIN_TOKENS = 48    # Smallest truncated piece worth adding when the budget runs out
+_TAG_RE = re.compile(r"\[(\w+): ([^\]]*)\]")
+
+
+def split_chunk(doc: str) -> tuple[dict, str]:
+    """({file, type, source, page, section}, body) of a chunk_text chunk; ({}, doc) for untagged text."""
+    if doc.startswith("[file:"):
+        head, sep, body = doc.partition("\n---\n")
+        if sep:
+            return dict(_TAG_RE.findall(head)), body
+    return {}, doc
+
+
+def _overlap(a: str, b: str) -> int:
+    """Length of the longest suffix of `a` that is a prefix of `b` (0 below PACK_MIN_OVERLAP)."""
+    probe = b[:PACK_MIN_OVERLAP]
+    if len(probe) < PACK_MIN_OVERLAP:
+        return 0
+    pos = a.find(probe, max(0, len(a) - len(b)))
+    while pos >= 0:
+        if b.startswith(a[pos:]):
+            return len(a) - pos
+        pos = a.find(probe, pos + 1)
+    return 0
+
+
+def merge_chunks(docs: list[str]) -> tuple[list[dict], int]:
+    """Group ranked chunks by source and merge overlapping/contained ones. Returns (groups, merges)."""
+    groups = {}
+    merges = 0
+    for rank, doc in enumerate(docs):
+        tags, body = split_chunk(doc)
+        body = body.strip()
+        key = tags.get("file") or f"#{rank}"
+        group = groups.setdefault(key, {"tags": tags, "rank": rank, "spans": []})
+        loc = {k: tags[k] for k in ("page", "section") if k in tags}
+        span = {"loc": loc, "body": body, "rank": rank}
+        merged = True
+        while merged:
+            merged = False
+            for other in group["spans"]:
+                if other["loc"] != span["loc"]:
+                    continue
+                a, b = other["body"], span["body"]
+                if b in a or a in b:
+                    text = a if len(a) >= len(b) else b
+                elif (k := _overlap(a, b)):
+                    text = a + b[k:]
+                elif (k := _overlap(b, a)):
+                    text = b + a[k:]
+                else:
+                    continue
+                group["spans"].remove(other)
+                span = {"loc": loc, "body": text, "rank": min(other["rank"], span["rank"])}
+                merges += 1
+                merged = True
+                break
+        group["spans"].append(span)
+    for group in groups.values():
+        group["spans"].sort(key=lambda sp: sp["rank"])
+    return sorted(groups.values(), key=lambda g: g["rank"]), merges
+
+
+def _truncate_tokens(text: str, n: int) -> str:
+    """First ~n tokens of `text`, cut back to a paragraph/line/sentence end when one is near."""
+    enc = _get_encoder()
+    cut = enc.decode(enc.encode_ordinary(text)[:n]) if enc is not None else text[:n * 4]
+    for sep in ("\n\n", "\n", ". "):
+        i = cut.rfind(sep)
+        if i > len(cut) // 2:
+            return cut[:i + (1 if sep == ". " else 0)].rstrip()
+    return cut.rstrip()
+
+
+def chat_num_ctx(context_tokens: int = 0) -> int:
+    """num_ctx to send: RAG_NUM_CTX, else room for a `context_tokens` cap (rounded up to 1024, so it stays stable), else 0."""
+    if NUM_CTX > 0:
+        return NUM_CTX
+    if context_tokens > 0:
+        # Same num_ctx for the same cap, or Ollama reloads the model when it changes
+        return max(DEFAULT_NUM_CTX, -(-(context_tokens + ANSWER_TOKENS + 512) // 1024) * 1024)
+    return 0
+
+
+def context_budget(prompt_text: str, cap: int = 0) -> int:
+    """Context tokens that fit chat_num_ctx(cap) next to `prompt_text` (system prompt + question) and the answer; 0 = no limit."""
+    num_ctx = chat_num_ctx(cap)
+    if not num_ctx:
+        return 0  # window is the model's own setting (unknown here): merge only, never truncate
+    room = num_ctx - _token_count(prompt_text) - ANSWER_TOKENS - 32
+    room = max(PACK_MIN_TOKENS * 4, room)
+    return min(room, cap) if cap > 0 else room
+
+
+def pack_context(docs: list[str], web_parts: list[tuple[str, str, str]], budget: int) -> tuple[str, dict]:
+    """Prompt context from ranked chunks and web parts within `budget` tokens (0 = all). Returns (context, stats)."""
+    groups, merges = merge_chunks(docs)
+    headers = [" ".join(f"[{k}: {g['tags'][k]}]" for k in ("file", "type", "source") if k in g["tags"]) for g in groups]
+    units = []  # (group index, or None for a web part; span/part index; text) in fill order
+    for _, gi, si in sorted((sp["rank"], gi, si) for gi, g in enumerate(groups) for si, sp in enumerate(g["spans"])):
+        sp = groups[gi]["spans"][si]
+        loc = " ".join(f"[{k}: {v}]" for k, v in sp["loc"].items())
+        units.append((gi, si, (loc + "\n" if loc else "") + sp["body"]))
+    units += [(None, i, body) for i, (_, _, body) in enumerate(web_parts)]
+    web_headers = [f"[{i}] [url: {url}] [title: {title}]" for i, (url, title, _) in enumerate(web_parts, 1)]
+    raw_docs = "\n\n".join(f"[doc {i+1}] {d}" for i, d in enumerate(docs))
+    counts = _token_counts(headers + web_headers + [text for _, _, text in units] + [raw_docs, format_web_context(web_parts)])
+    header_tokens, web_header_tokens = counts[:len(headers)], counts[len(headers):len(headers) + len(web_parts)]
+    unit_tokens = counts[len(headers) + len(web_parts):-2]
+    raw = counts[-2] + counts[-1]
+
+    kept = {}  # group index -> {span index: text}
+    web_kept = {}
+    used = dropped = dropped_tokens = 0
+    truncated = False
+    for (gi, si, text), n in zip(units, unit_tokens):
+        # Separators and [doc N] / [N] prefixes are not in the per-unit counts
+        if gi is None:
+            overhead = web_header_tokens[si] + 6
+        else:
+            overhead = 5 if gi in kept else header_tokens[gi] + 10
+        if budget > 0 and used + overhead + n > budget:
+            room = budget - used - overhead
+            if truncated or room < PACK_MIN_TOKENS:
+                dropped += 1
+                dropped_tokens += n
+                continue
+            dropped_tokens += n - room
+            text, n, truncated = _truncate_tokens(text, room), room, True
+        used += overhead + n
+        if gi is None:
+            web_kept[si] = text
+        else:
+            kept.setdefault(gi, {})[si] = text
+
+    parts = []
+    if kept:
+        blocks = []
+        for i, gi in enumerate(sorted(kept), 1):  # groups are already in rank order
+            body = "\n[...]\n".join(kept[gi][si] for si in sorted(kept[gi]))
+            blocks.append(f"[doc {i}] {headers[gi]}\n{body}" if headers[gi] else f"[doc {i}] {body}")
+        parts.append("Documents:\n" + "\n\n".join(blocks))
+    if web_kept:
+        parts.append("Web search results:\n" + format_web_context([(web_parts[i][0], web_parts[i][1], web_kept[i]) for i in sorted(web_kept)]))
+    context = "\n\n---\n\n".join(parts)
+    tokens = _token_count(context) if context else 0
+    return context, {
+        "context_tokens": tokens, "context_tokens_raw": raw,
+        "context_tokens_saved": max(0, raw - tokens - dropped_tokens), "context_tokens_dropped": dropped_tokens,
+        "context_budget": budget, "context_merged": merges, "context_dropped": dropped,
+    }
+
+
 # --- Caching ---
-_cache: dict[str, tuple[str, float]] = {}
 CACHE_TTL = 300  # 5 min
+CACHE_MAX_ENTRIES = int(os.environ.get("RAG_CACHE_MAX_ENTRIES", "1024"))
+CACHE_MAX_MB = int(os.environ.get("RAG_CACHE_MAX_MB", "64"))
+_cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_MAX_MB * 1024 * 1024, CACHE_TTL)  # In-process tier (Redis is shared)
+CACHE_DISK_PATH = DEFAULT_CACHE_DIR / "answers.sqlite"
+CACHE_DISK_ENABLED = os.environ.get("RAG_CACHE_DISK", "true").lower() in ("1", "true", "yes")
+
+
+class DiskCache:
+    """Persistent SQLite tier of cache_get/cache_set (stdlib only), so repeated CLI queries hit without Redis."""
+
+    def __init__(self, path: Path = CACHE_DISK_PATH, ttl: float = CACHE_TTL, max_entries: int = CACHE_MAX_ENTRIES):
+        import sqlite3
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._puts = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, timeout=1)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires REAL NOT NULL);
+            CREATE INDEX IF NOT EXISTS cache_expires ON cache(expires);
+            """
+        )
+
+    def get(self, key: str) -> str | None:
+        import sqlite3
+        try:
+            with self._lock:
+                row = self._db.execute("SELECT value FROM cache WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+        except sqlite3.Error:
+            return None
+        return row[0] if row else None
+
+    def put(self, key: str, value: str):
+        import sqlite3
+        now = time.time()
+        try:
+            with self._lock, self._db:
+                self._db.execute("INSERT OR REPLACE INTO cache (key, value, expires) VALUES (?, ?, ?)", (key, value, now + self.ttl))
+                self._puts += 1
+                if self._puts % 64 == 1:
+                    self._db.execute("DELETE FROM cache WHERE expires <= ?", (now,))
+                    self._db.execute(
+                        "DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                        (self.max_entries,),
+                    )
+        except sqlite3.Error as e:
+            log("cache_disk_error", {"error": str(e)})
+
+
+_disk_cache = None
+_disk_cache_failed = False
+_disk_cache_lock = threading.Lock()
+
+
+def disk_cache() -> DiskCache | None:
+    """Process-wide DiskCache, or None when disabled (RAG_CACHE_DISK=0) or the file cannot be opened."""
+    global _disk_cache, _disk_cache_failed
+    if not CACHE_DISK_ENABLED or _disk_cache_failed:
+        return None
+    with _disk_cache_lock:
+        if _disk_cache is None and not _disk_cache_failed:
+            try:
+                _disk_cache = DiskCache()
+            except Exception as e:
+                _disk_cache_failed = True
+                log("cache_disk_error", {"error": str(e)})
+    return _disk_cache
+
+
+REDIS_POOL_SIZE = int(os.environ.get("RAG_REDIS_POOL_SIZE", "16"))
+REDIS_TIMEOUT = float(os.environ.get("RAG_REDIS_TIMEOUT", "0.5"))     # Socket timeouts, so a dead Redis cannot stall queries
+REDIS_COOLDOWN = float(os.environ.get("RAG_REDIS_COOLDOWN", "30"))    # Seconds memory-only after a Redis failure
+
+_redis = None
+_redis_lock = threading.Lock()
+_redis_down_until = 0.0
 
 
 def _redis_client():
-    """Return Redis client if RAG_REDIS_URL is set, else None."""
+    """Shared pooled Redis client if RAG_REDIS_URL is set, else None (also while the circuit breaker is open)."""
+    global _redis
     url = os.environ.get("RAG_REDIS_URL", "").strip()
-    if not url:
-        return None
-    try:
-        import redis
-        return redis.from_url(url, decode_responses=True)
-    except Exception:
+    if not url or time.time() < _redis_down_until:
         return None
+    with _redis_lock:
+        if _redis is None:
+            try:
+                import redis
+                pool = redis.ConnectionPool.from_url(
+                    url, decode_responses=True, max_connections=REDIS_POOL_SIZE,
+                    socket_timeout=REDIS_TIMEOUT, socket_connect_timeout=REDIS_TIMEOUT, health_check_interval=30,
+                )
+                _redis = redis.Redis(connection_pool=pool)
+            except Exception as e:
+                _redis_failed(e)
+                return None
+        return _redis
+
+
+def _redis_failed(e: Exception):
+    """Open the circuit: skip Redis for REDIS_COOLDOWN seconds (logged once per opening)."""
+    global _redis_down_until
+    if time.time() >= _redis_down_until:
+        log("redis_error", {"error": str(e), "cooldown_s": REDIS_COOLDOWN})
+    _redis_down_until = time.time() + REDIS_COOLDOWN
 
 
 def cache_get(key: str) -> str | None:
@@ -541,13 +1835,16 @@ def cache_get(key: str) -> str | None:
     if r:
         try:
             v = r.get(f"rag:{key}")
-            return v
-        except Exception:
-            pass
-    val = _cache.get(key)
-    if val and time.time() - val[1] < CACHE_TTL:
-        return val[0]
-    return None
+            if v is not None:
+                return v
+        except Exception as e:
+            _redis_failed(e)
+    v = _cache.get(key)
+    if v is None and (disk := disk_cache()) is not None:
+        v = disk.get(key)
+        if v is not None:
+            _cache.put(key, v)
+    return v
 
 
 def cache_set(key: str, value: str):
@@ -555,42 +1852,420 @@ def cache_set(key: str, value: str):
     if r:
         try:
             r.setex(f"rag:{key}", CACHE_TTL, value)
-        except Exception:
-            pass
-    _cache[key] = (value, time.time())
+        except Exception as e:
+            _redis_failed(e)
+    _cache.put(key, value)
+    if (disk := disk_cache()) is not None:
+        disk.put(key, value)
+
+
+# Semantic answer cache (query embedding similarity). Off by default: paraphrases with opposite
+# meaning ("enable X" / "disable X") can exceed the threshold and get the other question's answer.
+SEMANTIC_CACHE_ENABLED = os.environ.get("RAG_SEMANTIC_CACHE", "false").lower() in ("1", "true", "yes")
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("RAG_SEMANTIC_CACHE_THRESHOLD", "0.95"))  # Cosine similarity for a hit
+SEMANTIC_CACHE_MAX = int(os.environ.get("RAG_SEMANTIC_CACHE_MAX", "512"))                # Entries per namespace
+
+
+class SemanticCache:
+    """Answers looked up by query embedding: a hit needs cosine similarity >= threshold in the same namespace."""
+
+    def __init__(self, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self._local = LRUCache(64)  # namespace -> [(unit vector, answer, ts)]
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _unit(vec):
+        import numpy as np
+        v = np.asarray(vec, dtype=np.float32)
+        n = float(np.linalg.norm(v))
+        return v / n if n else v
+
+    @staticmethod
+    def _redis_key(namespace: str) -> str:
+        return "rag:sem:" + hashlib.sha256(namespace.encode("utf-8")).hexdigest()[:24]
+
+    def get(self, namespace: str, vec: list[float]) -> tuple[str, float] | None:
+        """Best cached (answer, similarity) at or above the threshold, else None."""
+        import base64
+        import numpy as np
+        q = self._unit(vec)
+        now = time.time()
+        with self._lock:
+            entries = [(v, a) for v, a, ts in (self._local.get(namespace) or []) if now - ts < CACHE_TTL]
+        r = _redis_client()
+        if r:
+            try:
+                for raw in r.lrange(self._redis_key(namespace), 0, -1):
+                    row = json.loads(raw)
+                    entries.append((np.frombuffer(base64.b64decode(row["v"]), dtype=np.float32), row["a"]))
+            except Exception as e:
+                _redis_failed(e)
+        best = None
+        for v, answer in entries:
+            if v.shape != q.shape:
+                continue
+            sim = float(np.dot(q, v))
+            if sim >= self.threshold and (best is None or sim > best[1]):
+                best = (answer, sim)
+        return best
+
+    def put(self, namespace: str, vec: list[float], answer: str):
+        import base64
+        v = self._unit(vec)
+        now = time.time()
+        with self._lock:
+            entries = [e for e in (self._local.get(namespace) or []) if now - e[2] < CACHE_TTL]
+            entries.append((v, answer, now))
+            self._local.put(namespace, entries[-self.max_entries:])
+        r = _redis_client()
+        if r:
+            try:
+                key = self._redis_key(namespace)
+                pipe = r.pipeline()
+                pipe.lpush(key, json.dumps({"v": base64.b64encode(v.tobytes()).decode("ascii"), "a": answer}))
+                pipe.ltrim(key, 0, self.max_entries - 1)
+                pipe.expire(key, CACHE_TTL)
+                pipe.execute()
+            except Exception as e:
+                _redis_failed(e)
+
+
+_semantic_cache = None
+_semantic_cache_lock = threading.Lock()
+
+
+def semantic_cache() -> SemanticCache | None:
+    """Process-wide SemanticCache, or None unless enabled (RAG_SEMANTIC_CACHE=1)."""
+    global _semantic_cache
+    if not SEMANTIC_CACHE_ENABLED:
+        return None
+    with _semantic_cache_lock:
+        if _semantic_cache is None:
+            _semantic_cache = SemanticCache()
+    return _semantic_cache
 
 
 # --- Logging & Alerting ---
 ALERT_LATENCY_MS = int(os.environ.get("RAG_ALERT_LATENCY_MS", "0"))
 ALERT_WEBHOOK = os.environ.get("RAG_ALERT_WEBHOOK", "").strip()
+ALERT_DEDUP_S = float(os.environ.get("RAG_ALERT_DEDUP_S", "300"))        # Same (type, event) alerted at most once per window
+ALERT_MAX_PER_MIN = int(os.environ.get("RAG_ALERT_MAX_PER_MIN", "10"))   # Webhook calls per minute, all alerts
+LOG_MAX_MB = float(os.environ.get("RAG_LOG_MAX_MB", "10"))              # Rotate rag.log at this size
+LOG_BACKUPS = int(os.environ.get("RAG_LOG_BACKUPS", "3"))               # rag.log.1 .. rag.log.N kept
+LOG_QUEUE_SIZE = 10000                                                  # Events buffered before log() drops
+
+
+class _LogWriter:
+    """Background thread behind `log()`: batched writes, size-based rotation, deduplicated and rate-limited alerts."""
+
+    def __init__(self, path: Path = LOG_PATH):
+        import atexit
+        import queue
+        from collections import deque
+        self.path = path
+        self.dropped = 0
+        self._queue = queue.Queue(LOG_QUEUE_SIZE)
+        self._alerts = queue.Queue(100)
+        self._alert_last = {}       # (type, event) -> ts of last delivered alert
+        self._alert_suppressed = {}  # (type, event) -> count since then
+        self._alert_times = deque()
+        self._f = None
+        self._thread = threading.Thread(target=self._run, name="rag-log", daemon=True)
+        self._thread.start()
+        self._alert_thread = None
+        if ALERT_WEBHOOK:
+            self._alert_thread = threading.Thread(target=self._deliver_alerts, name="rag-alert", daemon=True)
+            self._alert_thread.start()
+        atexit.register(self.close)
+
+    def put(self, record: dict):
+        import queue
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        import queue
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < 512:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            records = [r for r in batch if r is not None]
+            try:
+                self._write(records)
+            except Exception:
+                pass  # Logging must never take the caller down
+            if ALERT_WEBHOOK:
+                for r in records:
+                    self._check_alert(r)
+            if None in batch:
+                return
+
+    def _open(self):
+        """(Re)open LOG_PATH, also after another process rotated it."""
+        if self._f is not None:
+            try:
+                if os.stat(self.path).st_ino == os.fstat(self._f.fileno()).st_ino:
+                    return
+            except OSError:
+                pass
+            self._f.close()
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(self.path, "a", encoding="utf-8")
+
+    def _write(self, records: list[dict]):
+        if self.dropped:
+            records.append({"ts": datetime.utcnow().isoformat(), "event": "log_dropped", "count": self.dropped})
+            self.dropped = 0
+        if not records:
+            return
+        self._open()
+        self._f.write("".join(json.dumps(r, default=str) + "\n" for r in records))
+        self._f.flush()
+        if self._f.tell() >= LOG_MAX_MB * 1024 * 1024:
+            self._rotate()
+
+    def _rotate(self):
+        self._f.close()
+        self._f = None
+        if LOG_BACKUPS > 0:
+            for i in range(LOG_BACKUPS - 1, 0, -1):
+                src = self.path.with_name(f"{self.path.name}.{i}")
+                if src.exists():
+                    os.replace(src, self.path.with_name(f"{self.path.name}.{i + 1}"))
+            os.replace(self.path, self.path.with_name(f"{self.path.name}.1"))
+        else:
+            self.path.unlink(missing_ok=True)
 
-
-def log(event: str, data: dict):
-    LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
-    line = json.dumps({"ts": datetime.utcnow().isoformat(), "event": event, **data}) + "\n"
-    with open(LOG_PATH, "a", encoding="utf-8") as f:
-        f.write(line)
-    if ALERT_WEBHOOK:
-        latency = data.get("latency_total_ms") or data.get("latency_ms")
+    def _check_alert(self, record: dict):
+        event = record.get("event", "")
+        latency = record.get("latency_total_ms") or record.get("latency_ms")
         if ALERT_LATENCY_MS and latency and float(latency) > ALERT_LATENCY_MS:
-            _send_alert("high_latency", {"event": event, "latency_ms": latency, **data})
+            self._queue_alert("high_latency", {"latency_ms": latency, **record})
         if event.endswith("_error") or "error" in event.lower():
-            _send_alert("error", {"event": event, **data})
+            self._queue_alert("error", record)
+
+    def _queue_alert(self, typ: str, payload: dict):
+        import queue
+        now = time.time()
+        key = (typ, payload.get("event"))
+        while self._alert_times and now - self._alert_times[0] > 60:
+            self._alert_times.popleft()
+        if now - self._alert_last.get(key, 0) < ALERT_DEDUP_S or len(self._alert_times) >= ALERT_MAX_PER_MIN:
+            self._alert_suppressed[key] = self._alert_suppressed.get(key, 0) + 1
+            return
+        self._alert_last[key] = now
+        self._alert_times.append(now)
+        try:
+            self._alerts.put_nowait((typ, {**payload, "suppressed": self._alert_suppressed.pop(key, 0)}))
+        except queue.Full:
+            pass
+
+    def _deliver_alerts(self):
+        while True:
+            item = self._alerts.get()
+            if item is None:
+                return
+            _send_alert(*item)
+
+    def close(self):
+        """Flush queued events (and pending alerts) before the process exits."""
+        try:
+            self._queue.put(None, timeout=1)
+            self._thread.join(timeout=2)
+            if self._alert_thread is not None:
+                self._alerts.put(None, timeout=1)
+                self._alert_thread.join(timeout=6)
+        except Exception:
+            pass
+
+
+_log_writer = None
+_log_writer_lock = threading.Lock()
+
+
+def log(event: str, data: dict):
+    """Structured JSON log line to LOG_PATH (asynchronous: enqueue only)."""
+    global _log_writer
+    if _log_writer is None:
+        with _log_writer_lock:
+            if _log_writer is None:
+                _log_writer = _LogWriter()
+    _log_writer.put({"ts": datetime.utcnow().isoformat(), "event": event, **data})
 
 
 def _send_alert(typ: str, payload: dict):
     if not ALERT_WEBHOOK:
         return
     try:
-        import requests
-        requests.post(ALERT_WEBHOOK, json={"type": typ, **payload}, timeout=5)
+        http_session("alerts", 2).post(ALERT_WEBHOOK, json={"type": typ, **payload}, timeout=5)
     except Exception:
         pass
 
 
+# --- Metrics (per-stage spans, latency histograms) ---
+METRIC_BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000)
+METRIC_WINDOW = 2048  # Recent samples per stage kept for p50/p95/p99
+
+
+class StageMetrics:
+    """Per-stage latency histograms (cumulative buckets + recent-sample quantiles) and counters."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}    # stage -> {"buckets": [...], "sum": ms, "count": n, "recent": deque}
+        self._counters = {}  # (name, ((label, value), ...)) -> count
+
+    def observe(self, stage: str, ms: float):
+        from collections import deque
+        with self._lock:
+            h = self._stages.get(stage)
+            if h is None:
+                h = self._stages[stage] = {
+                    "buckets": [0] * len(METRIC_BUCKETS_MS), "sum": 0.0, "count": 0, "recent": deque(maxlen=METRIC_WINDOW),
+                }
+            for i, le in enumerate(METRIC_BUCKETS_MS):
+                if ms <= le:
+                    h["buckets"][i] += 1
+            h["sum"] += ms
+            h["count"] += 1
+            h["recent"].append(ms)
+
+    def inc(self, name: str, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+
+    @staticmethod
+    def _quantile(sorted_ms: list[float], q: float) -> float:
+        return sorted_ms[min(len(sorted_ms) - 1, int(q * len(sorted_ms)))] if sorted_ms else 0.0
+
+    def snapshot(self) -> dict:
+        """{stage: {count, mean_ms, p50_ms, p95_ms, p99_ms}} (quantiles over the last METRIC_WINDOW samples)."""
+        with self._lock:
+            stages = {k: (v["count"], v["sum"], sorted(v["recent"])) for k, v in self._stages.items()}
+        return {
+            stage: {
+                "count": count,
+                "mean_ms": round(total / count, 2) if count else 0.0,
+                **{f"p{int(q * 100)}_ms": round(self._quantile(recent, q), 2) for q in (0.5, 0.95, 0.99)},
+            }
+            for stage, (count, total, recent) in sorted(stages.items())
+        }
+
+    def prometheus(self) -> str:
+        """Prometheus text exposition (histogram per stage, quantile gauges, counters)."""
+        with self._lock:
+            stages = {k: (list(v["buckets"]), v["sum"], v["count"], sorted(v["recent"])) for k, v in self._stages.items()}
+            counters = dict(self._counters)
+        out = [
+            "# HELP rag_stage_duration_seconds Latency of RAG pipeline stages.",
+            "# TYPE rag_stage_duration_seconds histogram",
+        ]
+        for stage, (buckets, total, count, _) in sorted(stages.items()):
+            for le, n in zip(METRIC_BUCKETS_MS, buckets):
+                out.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="{le / 1000:g}"}} {n}')
+            out.append(f'rag_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count}')
+            out.append(f'rag_stage_duration_seconds_sum{{stage="{stage}"}} {total / 1000:.6f}')
+            out.append(f'rag_stage_duration_seconds_count{{stage="{stage}"}} {count}')
+        out += [
+            f"# HELP rag_stage_duration_quantile_seconds Stage latency quantiles over the last {METRIC_WINDOW} samples.",
+            "# TYPE rag_stage_duration_quantile_seconds gauge",
+        ]
+        for stage, (_, _, _, recent) in sorted(stages.items()):
+            for q in (0.5, 0.95, 0.99):
+                out.append(f'rag_stage_duration_quantile_seconds{{stage="{stage}",quantile="{q}"}} {self._quantile(recent, q) / 1000:.6f}')
+        for name in sorted({n for n, _ in counters}):
+            out.append(f"# TYPE {name} counter")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    label_str = ",".join(f'{k}="{v}"' for k, v in labels)
+                    out.append(f"{name}{{{label_str}}} {value}" if label_str else f"{name} {value}")
+        return "\n".join(out) + "\n"
+
+
+metrics = StageMetrics()
+_spans = contextvars.ContextVar("rag_spans", default=None)
+
+
+@contextlib.contextmanager
+def span(stage: str):
+    """Time the enclosed block: observed in `metrics` and added to the current request's spans."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        metrics.observe(stage, ms)
+        spans = _spans.get()
+        if spans is not None:
+            spans.append((stage, ms))
+
+
+def traced(fn):
+    """Run `fn` with a fresh span list (read with `current_spans`). Worker threads need contextvars.copy_context()."""
+    @functools.wraps(fn)
+    def wrapper(*a, **kw):
+        token = _spans.set([])
+        try:
+            return fn(*a, **kw)
+        finally:
+            _spans.reset(token)
+    return wrapper
+
+
+def current_spans() -> dict:
+    """Spans of the current request as {stage: ms}; stages seen more than once (url_fetch) give a list."""
+    out = {}
+    for stage, ms in _spans.get() or []:
+        ms = round(ms, 1)
+        if stage not in out:
+            out[stage] = ms
+        elif isinstance(out[stage], list):
+            out[stage].append(ms)
+        else:
+            out[stage] = [out[stage], ms]
+    return out
+
+
 # --- Incremental indexing ---
+INDEX_EXTENSIONS = (".pdf", ".docx", ".doc", ".txt", ".md", ".markdown")   # Picked up inside directories by default
+INDEX_EXCLUDE = (".*", "node_modules", "__pycache__")                     # Always skipped inside directories
+
+
 def file_hash(path: Path) -> str:
-    return hashlib.sha256(path.read_bytes()).hexdigest()
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_state(path: Path) -> dict:
+    """Manifest entry: size, mtime, inode and sha256 (stat taken before hashing)."""
+    st = path.stat()
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": st.st_ino, "sha256": file_hash(path)}
+
+
+def stat_unchanged(path: Path, entry) -> bool:
+    """True when size/mtime/inode still match the manifest entry (old hash-only entries never match)."""
+    if not isinstance(entry, dict):
+        return False
+    try:
+        st = path.stat()
+    except OSError:
+        return False
+    return (st.st_size, st.st_mtime_ns, st.st_ino) == (entry.get("size"), entry.get("mtime_ns"), entry.get("ino"))
+
+
+def entry_hash(entry) -> str | None:
+    return entry if isinstance(entry, str) else (entry or {}).get("sha256")
 
 
 def load_index_manifest(index_dir: Path) -> dict:
@@ -601,16 +2276,1420 @@ def load_index_manifest(index_dir: Path) -> dict:
 
 
 def save_index_manifest(index_dir: Path, manifest: dict):
-    (index_dir / ".manifest.json").write_text(json.dumps(manifest, indent=2))
+    """Write compactly via a temp file + rename, so readers (index_version) never see half a file."""
+    p = index_dir / ".manifest.json"
+    tmp = p.with_name(".manifest.json.tmp")
+    tmp.write_text(json.dumps(manifest, separators=(",", ":")))
+    os.replace(tmp, p)
+
+
+def path_selected(rel: str, include: list[str] | None = None, exclude: list[str] | None = None) -> bool:
+    """Whether a file at `rel` (relative to an indexed directory) passes the include/exclude globs."""
+    from fnmatch import fnmatch
+    parts = Path(rel).parts
+    for g in (*INDEX_EXCLUDE, *(exclude or [])):
+        if fnmatch(rel, g) or any(fnmatch(p, g) for p in parts):
+            return False
+    name = parts[-1] if parts else rel
+    if include:
+        return any(fnmatch(name, g) for g in include)
+    return Path(name).suffix.lower() in INDEX_EXTENSIONS
+
+
+def expand_index_paths(paths: list[str], include: list[str] | None = None, exclude: list[str] | None = None) -> tuple[list[Path], list[Path]]:
+    """Resolve CLI paths into (files, directories), walking directories recursively with path_selected."""
+    files, roots, seen = [], [], set()
+    for fp in paths:
+        path = Path(fp).expanduser().resolve()
+        if not path.is_dir():
+            if path not in seen:
+                seen.add(path)
+                files.append(path)
+            continue
+        roots.append(path)
+        for dirpath, dirnames, filenames in os.walk(path):
+            rel_dir = os.path.relpath(dirpath, path)
+            rel_dir = "" if rel_dir == "." else rel_dir
+            # Prune excluded directories (checked as if they were files without the include test)
+            dirnames[:] = sorted(d for d in dirnames if path_selected(os.path.join(rel_dir, d), ["*"], exclude))
+            for name in sorted(filenames):
+                if path_selected(os.path.join(rel_dir, name), include, exclude):
+                    f = Path(dirpath) / name
+                    if f not in seen:
+                        seen.add(f)
+                        files.append(f)
+    return files, roots
+
+
+# --- Vector store: memory-mapped NumPy backend ---
+# Index backend for new indexes: chroma | numpy (existing indexes keep the backend they were built with)
+VECTOR_STORE = os.environ.get("RAG_VECTOR_STORE", "chroma")
+VECTOR_DTYPE = os.environ.get("RAG_VECTOR_DTYPE", "int8")      # numpy backend: int8 (+ per-row scale) | float16
+IVF_LISTS = int(os.environ.get("RAG_IVF_LISTS", "0"))          # numpy backend: IVF partitions (0 = exact search)
+IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "8"))        # Partitions scanned per query
+VECTOR_BLOCK_ROWS = 4096                                       # Rows widened to float32 and scored at a time
+
+
+def _where_sql(where: dict) -> tuple[str, list]:
+    """Compile a Chroma `where` dict (as built by chroma_where) to SQL over records.metadata (JSON)."""
+    ops = {"$eq": "=", "$ne": "!=", "$gt": ">", "$gte": ">=", "$lt": "<", "$lte": "<="}
+    clauses, params = [], []
+    for key, cond in where.items():
+        if key in ("$and", "$or"):
+            parts = [_where_sql(w) for w in cond]
+            clauses.append("(" + f" {key[1:].upper()} ".join(p for p, _ in parts) + ")")
+            for _, p in parts:
+                params.extend(p)
+            continue
+        # Literal JSON path (not a parameter) so the expression indexes on records can be used
+        col = "json_extract(metadata, '$.\"{}\"')".format(key.replace("'", "''").replace('"', ""))
+        if not isinstance(cond, dict):
+            cond = {"$eq": cond}
+        for op, value in cond.items():
+            if op in ops:
+                clauses.append(f"{col} {ops[op]} ?")
+                params.append(value)
+            elif op in ("$in", "$nin"):
+                marks = ",".join("?" * len(value)) or "NULL"
+                clauses.append(f"{col} {'NOT IN' if op == '$nin' else 'IN'} ({marks})")
+                params.extend(value)
+            else:
+                raise ValueError(f"Unsupported where operator: {op}")
+    return (" AND ".join(clauses) if clauses else "1"), params
+
+
+class NumpyStore:
+    """Chroma-compatible collection over memory-mapped int8/float16 vectors and a SQLite records table."""
+
+    DIR = "vectors"
+
+    @classmethod
+    def exists(cls, index_dir: Path) -> bool:
+        return (Path(index_dir) / cls.DIR / "records.sqlite").exists()
+
+    @classmethod
+    def destroy(cls, index_dir: Path):
+        import shutil
+        shutil.rmtree(Path(index_dir) / cls.DIR, ignore_errors=True)
+
+    def __init__(self, index_dir: Path, dtype: str | None = None, metadata: dict | None = None):
+        import sqlite3
+        self.dir = Path(index_dir) / self.DIR
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(str(self.dir / "records.sqlite"), check_same_thread=False)
+        self._db.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS records (
+                row INTEGER PRIMARY KEY, id TEXT UNIQUE NOT NULL, document TEXT, metadata TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS records_source ON records(json_extract(metadata, '$."source"'));
+            CREATE INDEX IF NOT EXISTS records_type ON records(json_extract(metadata, '$."file_type"'));
+            CREATE TABLE IF NOT EXISTS info (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+        self._maps = {}  # file name -> (rows, memmap)
+        self._version = None
+        self.info = {k: json.loads(v) for k, v in self._db.execute("SELECT key, value FROM info")}
+        if not self.info:
+            self.reset(metadata, dtype)
+
+    def reset(self, metadata: dict | None = None, dtype: str | None = None):
+        """Empty the store (new generation) with fresh collection metadata."""
+        dtype = dtype or VECTOR_DTYPE
+        if dtype not in ("float16", "int8"):
+            raise ValueError(f"Unsupported vector dtype: {dtype}")
+        with self._lock:
+            gen = self.info.get("gen", -1) if getattr(self, "info", None) else -1
+            self.info = {"dtype": dtype, "dim": 0, "gen": gen + 1, "ivf_lists": 0, "ivf_rows": 0, "metadata": metadata or {}}
+            with self._db:
+                self._db.execute("DELETE FROM records")
+                self._save_info(self.info)
+            self._drop_generation(gen)
+
+    def _drop_generation(self, gen: int):
+        for p in self.dir.glob(f"*.{gen}.*"):
+            p.unlink(missing_ok=True)
+        self._maps.clear()
+
+    def _sync(self):
+        """Reload info after another connection (e.g. an index run in another process) committed."""
+        version = self._db.execute("PRAGMA data_version").fetchone()[0]
+        if version != self._version:
+            self._version = version
+            info = {k: json.loads(v) for k, v in self._db.execute("SELECT key, value FROM info")}
+            if info.get("gen") != self.info.get("gen"):
+                self._maps.clear()
+            self.info = info
+
+    def _save_info(self, info: dict):
+        self._db.executemany("INSERT OR REPLACE INTO info (key, value) VALUES (?, ?)", [(k, json.dumps(v)) for k, v in info.items()])
+
+    @property
+    def metadata(self) -> dict:
+        return self.info["metadata"]
+
+    def _file(self, kind: str, gen: int | None = None) -> Path:
+        return self.dir / f"{kind}.{self.info['gen'] if gen is None else gen}.bin"
+
+    def _rows(self) -> int:
+        dim = self.info["dim"]
+        try:
+            size = self._file("vectors").stat().st_size
+        except OSError:
+            return 0
+        return size // (dim * (2 if self.info["dtype"] == "float16" else 1)) if dim else 0
+
+    def _map(self, kind: str, dtype: str, rows: int, dim: int = 0):
+        """Read-only memmap of the first `rows` rows of a file, reused until the row count changes."""
+        import numpy as np
+        name = self._file(kind).name
+        cached = self._maps.get(name)
+        if cached is None or cached[0] != rows:
+            shape = (rows, dim) if dim else (rows,)
+            cached = (rows, np.memmap(self.dir / name, dtype=dtype, mode="r", shape=shape) if rows else np.zeros(shape, dtype))
+            self._maps[name] = cached
+        return cached[1]
+
+    def _encode(self, embeddings) -> tuple:
+        import numpy as np
+        x = np.asarray(embeddings, dtype=np.float32)
+        x /= np.maximum(np.linalg.norm(x, axis=1, keepdims=True), 1e-12)
+        if self.info["dtype"] == "float16":
+            return x.astype(np.float16), None
+        scales = np.maximum(np.abs(x).max(axis=1), 1e-12) / 127.0
+        return np.round(x / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def count(self) -> int:
+        with self._lock:
+            self._sync()
+            return self._db.execute("SELECT COUNT(*) FROM records").fetchone()[0]
+
+    def upsert(self, ids: list[str], embeddings, documents: list[str] | None = None, metadatas: list[dict] | None = None):
+        import numpy as np
+        if not ids:
+            return
+        with self._lock:
+            self._sync()
+            width = {len(e) for e in embeddings}
+            dim = self.info["dim"] or len(embeddings[0])
+            if width != {dim}:
+                raise ValueError(f"Embedding dimension {', '.join(map(str, sorted(width - {dim}) or width))} does not match collection dimensionality {dim}")
+            if not self.info["dim"]:
+                self.info["dim"] = dim
+                with self._db:
+                    self._save_info(self.info)
+            vecs, scales = self._encode(embeddings)
+            start = self._rows()
+            # Vectors first: a crash before the records commit only leaves orphan rows
+            with open(self._file("vectors"), "ab") as f:
+                f.write(vecs.tobytes())
+            if scales is not None:
+                with open(self._file("scales"), "ab") as f:
+                    f.write(scales.tobytes())
+            if self.info["ivf_lists"]:
+                centroids = np.load(self.dir / f"ivf.{self.info['gen']}.npy")
+                assign = np.argmax(vecs.astype(np.float32) @ centroids.T, axis=1).astype(np.int32)
+                with open(self._file("assign"), "ab") as f:
+                    f.write(assign.tobytes())
+            documents = documents or [None] * len(ids)
+            metadatas = metadatas or [{}] * len(ids)
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO records (row, id, document, metadata) VALUES (?, ?, ?, ?)",
+                    [(start + i, ids[i], documents[i], json.dumps(metadatas[i])) for i in range(len(ids))],
+                )
+
+    add = upsert
+
+    def update(self, ids: list[str], metadatas: list[dict]):
+        with self._lock, self._db:
+            self._db.executemany("UPDATE records SET metadata = ? WHERE id = ?", [(json.dumps(m), i) for i, m in zip(ids, metadatas)])
+
+    def _select(self, cols: str, ids: list[str] | None, where: dict | None, tail: str = "", tail_params: tuple = ()) -> list:
+        sql, params = _where_sql(where) if where else ("1", [])
+        if ids is not None:
+            out = []
+            for i in range(0, len(ids), 500):
+                batch = list(ids[i:i + 500])
+                out += self._db.execute(
+                    f"SELECT {cols} FROM records WHERE id IN ({','.join('?' * len(batch))}) AND {sql}", batch + params
+                ).fetchall()
+            return out
+        return self._db.execute(f"SELECT {cols} FROM records WHERE {sql} ORDER BY row{tail}", params + list(tail_params)).fetchall()
+
+    def get(self, ids: list[str] | None = None, where: dict | None = None, include=("metadatas", "documents"),
+            limit: int | None = None, offset: int | None = None) -> dict:
+        tail, tail_params = "", ()
+        if limit is not None or offset:
+            tail, tail_params = " LIMIT ? OFFSET ?", (-1 if limit is None else limit, offset or 0)
+        with self._lock:
+            self._sync()
+            rows = self._select("id, document, metadata", ids, where, tail, tail_params)
+        return {
+            "ids": [r[0] for r in rows],
+            "documents": [r[1] for r in rows] if "documents" in include else None,
+            "metadatas": [json.loads(r[2]) for r in rows] if "metadatas" in include else None,
+        }
+
+    def delete(self, ids: list[str] | None = None, where: dict | None = None):
+        with self._lock, self._db:
+            if ids is not None:
+                for i in range(0, len(ids), 500):
+                    batch = list(ids[i:i + 500])
+                    self._db.execute(f"DELETE FROM records WHERE id IN ({','.join('?' * len(batch))})", batch)
+            elif where:
+                sql, params = _where_sql(where)
+                self._db.execute(f"DELETE FROM records WHERE {sql}", params)
+
+    def query(self, query_embeddings, n_results: int = 10, include=("documents", "metadatas", "distances"), where: dict | None = None) -> dict:
+        import numpy as np
+        with self._lock:
+            self._sync()
+            rows, dim = self._rows(), self.info["dim"]
+            if not rows or not len(query_embeddings):
+                return {"ids": [[] for _ in query_embeddings], "documents": [[] for _ in query_embeddings], "metadatas": [[] for _ in query_embeddings], "distances": [[] for _ in query_embeddings]}
+            mat = self._map("vectors", self.info["dtype"], rows, dim)
+            scales = self._map("scales", "float32", rows) if self.info["dtype"] == "int8" else None
+            gen = self.info["gen"]
+            ivf = self.info["ivf_lists"] if self._file("assign").exists() and self._file("assign").stat().st_size >= 4 * rows else 0
+            assign = self._map("assign", "int32", rows) if ivf else None
+            centroids = np.load(self.dir / f"ivf.{self.info['gen']}.npy") if ivf else None
+            if where:
+                sql, params = _where_sql(where)
+                cand = np.fromiter((r for (r,) in self._db.execute(f"SELECT row FROM records WHERE {sql}", params)), dtype=np.int64)
+            elif self.count() == rows:
+                cand = None  # no orphans: every row is live
+            else:
+                cand = np.fromiter((r for (r,) in self._db.execute("SELECT row FROM records")), dtype=np.int64)
+        qs = np.asarray(query_embeddings, dtype=np.float32)
+        qs /= np.maximum(np.linalg.norm(qs, axis=1, keepdims=True), 1e-12)
+        pools = [cand] * len(qs)
+        if ivf and (cand is None or len(cand) > rows // 2):
+            # Only the rows assigned to the IVF_NPROBE partitions nearest to each query
+            for j, q in enumerate(qs):
+                probe = np.nonzero(np.isin(assign, np.argsort(-(centroids @ q))[:IVF_NPROBE]))[0]
+                pools[j] = probe if cand is None else np.intersect1d(cand, probe, assume_unique=True)
+            groups = [(pool, qs[j:j + 1]) for j, pool in enumerate(pools)]
+        else:
+            groups = [(cand, qs)]  # same rows for every query: one pass over the matrix
+        top = []
+        for pool, group in groups:
+            scores = self._scores(mat, scales, pool, group)
+            n = len(scores)
+            k = min(n_results, n)
+            for col in scores.T:
+                if not k:
+                    top.append(([], []))
+                    continue
+                best = np.argpartition(-col, k - 1)[:k]
+                best = best[np.argsort(-col[best])]
+                top.append(((best if pool is None else pool[best]).tolist(), col[best].tolist()))
+        with self._lock:
+            self._sync()
+            if self.info["gen"] != gen:
+                # Compacted while scoring: row numbers changed, score again
+                return self.query(query_embeddings, n_results, include, where)
+            wanted = sorted({r for row_ids, _ in top for r in row_ids})
+            found = {}
+            for i in range(0, len(wanted), 500):
+                batch = wanted[i:i + 500]
+                for r, id_, doc, meta in self._db.execute(
+                    f"SELECT row, id, document, metadata FROM records WHERE row IN ({','.join('?' * len(batch))})", batch
+                ):
+                    found[r] = (id_, doc, meta)
+        out = {"ids": [], "documents": [], "metadatas": [], "distances": []}
+        for row_ids, sims in top:
+            hits = [(found[r], s) for r, s in zip(row_ids, sims) if r in found]
+            out["ids"].append([h[0] for h, _ in hits])
+            out["documents"].append([h[1] for h, _ in hits])
+            out["metadatas"].append([json.loads(h[2]) for h, _ in hits])
+            out["distances"].append([1.0 - s for _, s in hits])
+        return out
+
+    @staticmethod
+    def _scores(mat, scales, pool, qs):
+        """Cosine similarity of rows (all, or `pool`) to each query: an (n, len(qs)) float32 array."""
+        import numpy as np
+        n = len(mat) if pool is None else len(pool)
+        out = np.empty((n, len(qs)), dtype=np.float32)
+        buf = np.empty((min(n, VECTOR_BLOCK_ROWS), mat.shape[1]), dtype=np.float32)
+        for b in range(0, n, VECTOR_BLOCK_ROWS):
+            sel = slice(b, min(n, b + VECTOR_BLOCK_ROWS)) if pool is None else pool[b:b + VECTOR_BLOCK_ROWS]
+            block = mat[sel]
+            np.copyto(buf[:len(block)], block)
+            np.matmul(buf[:len(block)], qs.T, out=out[b:b + len(block)])
+            if scales is not None:
+                out[b:b + len(block)] *= scales[sel][:, None]
+        return out
+
+    def optimize(self, ivf_lists: int = 0):
+        """After an index run: compact orphaned rows (> 25%) and build or drop the IVF partition."""
+        with self._lock:
+            self._sync()
+            rows, live = self._rows(), self.count()
+            rebuild = False
+            if rows - live > max(1000, rows // 4):
+                self._compact()
+                rebuild = bool(ivf_lists)
+                rows = self._rows()
+            if ivf_lists and live >= 39 * ivf_lists and (rebuild or self.info["ivf_lists"] != ivf_lists or rows > 2 * self.info["ivf_rows"]):
+                self._build_ivf(ivf_lists)
+            elif not ivf_lists and self.info["ivf_lists"]:
+                self.info["ivf_lists"] = 0
+                with self._db:
+                    self._save_info(self.info)
+
+    def _compact(self):
+        """Rewrite vectors of live rows into a new generation and renumber records in one transaction."""
+        import numpy as np
+        gen, dim, dtype = self.info["gen"], self.info["dim"], self.info["dtype"]
+        rows = self._rows()
+        live = np.fromiter((r for (r,) in self._db.execute("SELECT row FROM records ORDER BY row")), dtype=np.int64)
+        mat = self._map("vectors", dtype, rows, dim)
+        with open(self._file("vectors", gen + 1), "wb") as f:
+            for b in range(0, len(live), VECTOR_BLOCK_ROWS):
+                f.write(np.asarray(mat[live[b:b + VECTOR_BLOCK_ROWS]]).tobytes())
+        if dtype == "int8":
+            self._file("scales", gen + 1).write_bytes(np.asarray(self._map("scales", "float32", rows)[live]).tobytes())
+        self.info.update(gen=gen + 1, ivf_lists=0, ivf_rows=0)
+        with self._db:
+            # New row numbers never exceed the old ones, so ascending order cannot collide
+            self._db.executemany("UPDATE records SET row = ? WHERE row = ?", [(new, int(old)) for new, old in enumerate(live)])
+            self._save_info(self.info)
+        self._drop_generation(gen)
+        log("vector_compact", {"rows_before": rows, "rows_after": len(live)})
+
+    def _build_ivf(self, lists: int, iters: int = 10):
+        """k-means (on a sample of up to 64 rows per list) and assignment of every row."""
+        import numpy as np
+        rows, dim = self._rows(), self.info["dim"]
+        mat = self._map("vectors", self.info["dtype"], rows, dim)
+        rng = np.random.default_rng(0)
+        sample = np.asarray(mat[np.sort(rng.choice(rows, size=min(rows, 64 * lists), replace=False))], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), size=lists, replace=False)]
+        for _ in range(iters):
+            nearest = np.argmax(sample @ centroids.T, axis=1)
+            for c in range(lists):
+                members = sample[nearest == c]
+                if len(members):
+                    centroids[c] = members.mean(axis=0)
+            centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-12)
+        gen = self.info["gen"]
+        np.save(self.dir / f"ivf.{gen}.npy", centroids.astype(np.float32))
+        with open(self._file("assign"), "wb") as f:
+            for b in range(0, rows, VECTOR_BLOCK_ROWS):
+                block = np.asarray(mat[b:b + VECTOR_BLOCK_ROWS], dtype=np.float32)
+                f.write(np.argmax(block @ centroids.T, axis=1).astype(np.int32).tobytes())
+        self._maps.pop(self._file("assign").name, None)
+        self.info.update(ivf_lists=lists, ivf_rows=rows)
+        with self._db:
+            self._save_info(self.info)
+        log("vector_ivf", {"lists": lists, "rows": rows})
+
+
+# --- Runtime (shared by CLI commands and `serve`) ---
+class RagContext:
+    """Lazily opened vector store and BM25 index for one index dir (kept warm by `rag serve`)."""
+
+    def __init__(self, index_dir: Path):
+        self.index_dir = Path(index_dir).expanduser()
+        self.index_dir.mkdir(parents=True, exist_ok=True)
+        self.write_lock = threading.Lock()
+        self._lock = threading.RLock()
+        self._client = None
+        self._store = None
+        self._sparse = None
+        self._version = "none"
+        self._version_sig = None
+        self._sources = []
+        self._wheres = LRUCache(256)
+
+    def client(self):
+        # ChromaDB only needed for index/query/eval; research can run web-only without it
+        with self._lock:
+            if self._client is None:
+                import chromadb
+                from chromadb.config import Settings
+                self._client = chromadb.PersistentClient(path=str(self.index_dir), settings=Settings(anonymized_telemetry=False))
+            return self._client
+
+    def backend(self) -> str:
+        """Backend of the existing index (numpy/chroma), else RAG_VECTOR_STORE for a new one."""
+        if NumpyStore.exists(self.index_dir):
+            return "numpy"
+        if (self.index_dir / "chroma.sqlite3").exists():
+            return "chroma"
+        return VECTOR_STORE
+
+    def _numpy_store(self) -> NumpyStore:
+        with self._lock:
+            if self._store is None:
+                self._store = NumpyStore(self.index_dir)
+            return self._store
+
+    def collection(self):
+        if self.backend() == "numpy":
+            return self._numpy_store()
+        return self.client().get_or_create_collection("rag_docs", metadata={"hnsw:space": "cosine"})
+
+    def existing_collection(self):
+        """The index's collection, or None if nothing has been indexed yet."""
+        backend = self.backend()
+        if backend == "numpy" and NumpyStore.exists(self.index_dir):
+            return self._numpy_store()
+        if backend == "chroma" and (self.index_dir / "chroma.sqlite3").exists():
+            try:
+                return self.client().get_collection("rag_docs")
+            except Exception:
+                return None
+        return None
+
+    def create_collection(self, metadata: dict, backend: str, dtype: str | None = None):
+        """Empty collection on `backend` (full rebuild); the other backend's data is dropped."""
+        with self._lock:
+            if backend == "numpy":
+                if (self.index_dir / "chroma.sqlite3").exists():
+                    try:
+                        self.client().delete_collection("rag_docs")
+                    except Exception:
+                        pass
+                store = self._numpy_store()
+                store.reset(metadata, dtype)
+                return store
+            if NumpyStore.exists(self.index_dir):
+                self._store = None
+                NumpyStore.destroy(self.index_dir)
+            client = self.client()
+            try:
+                client.delete_collection("rag_docs")
+            except Exception:
+                pass
+            return client.create_collection("rag_docs", metadata={"hnsw:space": "cosine", **metadata})
+
+    def sparse(self) -> SparseIndex | None:
+        with self._lock:
+            if self._sparse is None:
+                self._sparse = SparseIndex.open_existing(self.index_dir)
+            return self._sparse
+
+    def set_sparse(self, sparse: SparseIndex):
+        with self._lock:
+            self._sparse = sparse
+
+    def index_version(self) -> str:
+        """Generation id of the index from `.manifest.json`, re-read only when its mtime/size change."""
+        p = self.index_dir / ".manifest.json"
+        try:
+            st = p.stat()
+        except OSError:
+            return "none"
+        sig = (st.st_mtime_ns, st.st_size)
+        with self._lock:
+            if sig != self._version_sig:
+                data = p.read_bytes()
+                h = hashlib.sha256(f"{st.st_mtime_ns}:".encode())
+                h.update(data)
+                self._version = h.hexdigest()[:16]
+                self._version_sig = sig
+                try:
+                    self._sources = sorted(json.loads(data))
+                except ValueError:
+                    self._sources = []
+            return self._version
+
+    def sources(self) -> list[str]:
+        """Sorted source paths in the manifest (refreshed together with index_version)."""
+        self.index_version()
+        with self._lock:
+            return self._sources
+
+    def where(self, filters: dict | None, coll) -> dict | None:
+        """chroma_where() for this index, memoized per index version and filter."""
+        if not filters:
+            return None
+        depth = int((coll.metadata or {}).get(PATH_DEPTH_KEY, 0))
+        key = (self.index_version(), depth, tuple(sorted(filters.items())))
+        hit = self._wheres.get(key)
+        if hit is None:
+            hit = chroma_where(filters, self.sources(), depth)
+            self._wheres.put(key, hit)
+        return hit
+
+
+def retrieve_docs(ctx: RagContext, query: str, args) -> list[str]:
+    """Hybrid retrieval (optionally expanded) using the CLI filter/rerank options; cached as chunk ids per index version."""
+    coll = ctx.collection()
+    if coll.count() == 0:
+        return []
+    filters = query_filters(args.filter_source, args.filter_type)
+    use_rerank = not args.no_rerank
+    cache_key = "|".join([
+        "retrieval", ctx.index_version(), args.embed_model, args.filter_source or "", args.filter_type or "",
+        f"rerank={use_rerank}", f"expand={args.model if args.expand_query else ''}", query,
+    ])
+    if not args.no_cache:
+        hit = cache_get(cache_key)
+        if hit:
+            ids = json.loads(hit)
+            got = coll.get(ids=ids, include=["documents"])
+            by_id = dict(zip(got["ids"] or [], got["documents"] or []))
+            if all(i in by_id for i in ids):
+                return [by_id[i] for i in ids]
+    where = ctx.where(filters, coll)
+    sparse = ctx.sparse()
+    if use_rerank:
+        prewarm_reranker()
+    if args.expand_query:
+        docs = retrieve_with_expansion(coll, query, args.embed_model, where, use_rerank, expand_query_fn=expand_query, model=args.model, sparse=sparse, filters=filters)
+    else:
+        docs = retrieve_hybrid(coll, query, args.embed_model, where, use_rerank, sparse, filters)
+    if docs and not args.no_cache:
+        cache_set(cache_key, json.dumps([chunk_id(d) for d in docs]))
+    return docs
+
+
+INDEX_FLUSH_SIZE = 256    # Chunks embedded + written to the vector store per flush
+
+
+def chunk_id(content: str) -> str:
+    return f"chunk_{hashlib.md5(content.encode()).hexdigest()[:12]}"
+
+
+PARSE_TIMEOUT = 300       # Seconds per file when parsing with --workers > 1
+
+
+def iter_file_chunks(path: Path, chunk_tokens: int = 0, chunk_strategy: str = "recursive", path_depth: int = 0):
+    """Yield chunk dicts for one file (load_document -> chunk_text), one page/section at a time."""
+    use_tokens = chunk_tokens > 0
+    chunk_size = chunk_tokens if use_tokens else CHUNK_SIZE
+    chunk_overlap = int(chunk_size * CHUNK_OVERLAP_RATIO)
+    semantic = chunk_strategy == "semantic"
+    for text, meta in load_document(path):
+        yield from chunk_text(
+            text,
+            meta["source"],
+            meta["file_type"],
+            meta.get("page"),
+            meta.get("section"),
+            chunk_size=chunk_size,
+            chunk_overlap=chunk_overlap,
+            use_tokens=use_tokens,
+            semantic=semantic,
+            path_depth=path_depth,
+        )
+
+
+def _parse_worker(path: str, chunk_tokens: int, chunk_strategy: str, path_depth: int) -> list[dict]:
+    return list(iter_file_chunks(Path(path), chunk_tokens, chunk_strategy, path_depth))
+
+
+def _failed(error: Exception):
+    """Chunk iterable that re-raises a worker error where run_index consumes it."""
+    raise error
+    yield
+
+
+def parse_files(
+    paths: list[Path], chunk_tokens: int = 0, chunk_strategy: str = "recursive", workers: int = 1,
+    timeout: float = PARSE_TIMEOUT, path_depth: int = 0,
+):
+    """Yield (path, chunks) in input order; with `workers` > 1 files are parsed in a process pool with a per-file `timeout`."""
+    if workers <= 1:
+        for path in paths:
+            yield path, iter_file_chunks(path, chunk_tokens, chunk_strategy, path_depth)
+        return
+    import multiprocessing as mp
+    from collections import deque
+    mp_ctx = mp.get_context("spawn")
+    pool = mp_ctx.Pool(workers)
+    todo = iter(paths)
+    pending = deque()
+
+    def submit(path: Path):
+        pending.append((path, pool.apply_async(_parse_worker, (str(path), chunk_tokens, chunk_strategy, path_depth)), time.time() + timeout))
+
+    try:
+        for path in paths[:workers]:
+            submit(next(todo))
+        while pending:
+            path, res, deadline = pending.popleft()
+            try:
+                chunks = res.get(timeout=max(0.0, deadline - time.time()))
+            except mp.TimeoutError:
+                chunks = _failed(TimeoutError(f"parsing timed out after {timeout:.0f}s"))
+                log("index_parse_timeout", {"path": str(path), "timeout_s": timeout})
+                pool.terminate()
+                pool = mp_ctx.Pool(workers)
+                others = [p for p, _, _ in pending]
+                pending.clear()
+                for p in others:
+                    submit(p)
+            except Exception as e:
+                chunks = _failed(e)
+            nxt = next(todo, None)
+            if nxt is not None:
+                submit(nxt)
+            yield path, chunks
+        pool.close()
+        pool.join()
+    finally:
+        pool.terminate()
+
+
+def run_index(ctx: RagContext, paths: list[str], args) -> dict:
+    """Index files and directories into the vector store + BM25 as a stream. Returns {chunks, files, removed} or {error}."""
+    index_dir = ctx.index_dir
+    manifest = load_index_manifest(index_dir)
+    files, roots = expand_index_paths(paths, args.include, args.exclude)
+    to_index, entries, gone = [], {}, []
+    unchanged = refreshed = 0
+    for path in files:
+        if not path.exists():
+            if args.incremental and str(path) in manifest:
+                gone.append(path)
+            else:
+                print(f"  Skip {path}: not found")
+            continue
+        entry = manifest.get(str(path)) if args.incremental else None
+        if entry is not None and stat_unchanged(path, entry):
+            unchanged += 1
+            continue
+        entries[path] = file_state(path)
+        if entry is not None and entry_hash(entry) == entries[path]["sha256"]:
+            manifest[str(path)] = entries[path]  # touched or old-format entry: same content
+            unchanged += 1
+            refreshed += 1
+            continue
+        to_index.append(path)
+    if args.incremental:
+        # Files under an indexed directory that are gone (deleted, or now excluded)
+        listed = {str(p) for p in files}
+        for root in roots:
+            prefix = str(root) + os.sep
+            gone.extend(Path(src) for src in manifest if src.startswith(prefix) and src not in listed)
+    if unchanged:
+        print(f"  Skip {unchanged} unchanged file(s)")
+    if refreshed:
+        save_index_manifest(index_dir, manifest)
+    if not to_index and not gone:
+        return {"chunks": 0, "files": 0, "message": "Nothing to index."}
+    path_depth = args.path_depth
+    if args.incremental:
+        # Keep the depth the collection was built with, so filters see uniform metadata
+        try:
+            path_depth = int((ctx.existing_collection().metadata or {}).get(PATH_DEPTH_KEY, 0))
+        except Exception:
+            pass
+
+    state = {"coll": None, "sparse": None}
+
+    def prepare():
+        """Open/reset the collection and BM25 index on first flush (nothing is touched if no file yields chunks)."""
+        nonlocal manifest
+        coll = ctx.existing_collection() if args.incremental else None
+        if coll is not None and args.vector_store and args.vector_store != ctx.backend():
+            print(f"  Note: --incremental keeps the index's {ctx.backend()} store; rebuild without it to switch")
+        if coll is None:
+            coll = ctx.create_collection({PATH_DEPTH_KEY: path_depth}, args.vector_store or ctx.backend(), args.vector_dtype)
+        bm25_fresh = not (index_dir / BM25_INDEX_FILE).exists()
+        sparse = SparseIndex(index_dir)
+        if not args.incremental:
+            sparse.clear()
+            manifest = {}
+            save_index_manifest(index_dir, manifest)
+        else:
+            # Forget every file to reindex before touching its chunks (one save), so an interrupted run re-indexes it
+            forgotten = [p for p in to_index if manifest.pop(str(p), None) is not None]
+            if forgotten:
+                save_index_manifest(index_dir, manifest)
+            if bm25_fresh:
+                # Index predates the BM25 file: backfill it from the whole collection once
+                offset = 0
+                while True:
+                    page = coll.get(include=["documents", "metadatas"], limit=INDEX_FLUSH_SIZE, offset=offset)
+                    if not page["ids"]:
+                        break
+                    sparse.add(page["ids"], page["documents"], page["metadatas"])
+                    offset += len(page["ids"])
+        state["coll"], state["sparse"] = coll, sparse
+
+    # Chunk-level diff for --incremental: ids stored for the files being reindexed -> stored metadata.
+    # Chunk ids hash the content (incl. its source tags), so an unchanged chunk keeps its id.
+    stored = {}
+    stored_by_file = {}
+    counts = {"added": 0, "kept": 0, "deleted": 0}
+
+    def begin_file(path: Path):
+        if state["coll"] is None:
+            prepare()
+        if args.incremental:
+            try:
+                got = state["coll"].get(where={"source": str(path)}, include=["metadatas"])
+            except Exception:
+                got = {"ids": [], "metadatas": []}
+            stored.update(zip(got["ids"] or [], got["metadatas"] or []))
+            stored_by_file[path] = set(got["ids"] or [])
+
+    def end_file(path: Path, seen: set):
+        """Delete the file's stored chunks that the new version no longer produces."""
+        vanished = [i for i in stored_by_file.pop(path, ()) if i not in seen]
+        if vanished:
+            state["coll"].delete(ids=vanished)
+            state["sparse"].delete_ids(vanished)
+            for i in vanished:
+                stored.pop(i, None)
+            counts["deleted"] += len(vanished)
+
+    removed = 0
+    if gone:
+        prepare()
+        for path in gone:
+            manifest.pop(str(path), None)
+        save_index_manifest(index_dir, manifest)
+        for path in gone:
+            try:
+                state["coll"].delete(where={"source": str(path)})
+            except Exception:
+                pass
+            state["sparse"].delete_source(str(path))
+            removed += 1
+            print(f"  Removed {path}")
+
+    cache = embedding_cache()
+    # The cache's counters are per process (serve, watch): report this run's share
+    cache_before = (cache.hits, cache.misses) if cache else (0, 0)
+    total_chunks = 0
+    files_done = 0
+
+    def flush(buf: list[dict]):
+        if not buf:
+            return
+        uniq = {}
+        for c in buf:
+            uniq[chunk_id(c["content"])] = c
+        # Already stored (same content): only positions/metadata may have moved
+        moved = [i for i in uniq if i in stored and stored[i] != uniq[i]["metadata"]]
+        if moved:
+            state["coll"].update(ids=moved, metadatas=[uniq[i]["metadata"] for i in moved])
+        ids = [i for i in uniq if i not in stored]
+        counts["kept"] += len(uniq) - len(ids)
+        counts["added"] += len(ids)
+        for i in uniq:
+            stored.pop(i, None)
+        if not ids:
+            return
+        contents = [uniq[i]["content"] for i in ids]
+        metadatas = [uniq[i]["metadata"] for i in ids]
+        embeddings = list(embed_texts(
+            contents, args.embed_model, batch_size=args.embed_batch_size, concurrency=args.embed_concurrency,
+            progress=False, cache=cache,
+        ))
+        state["coll"].upsert(ids=ids, embeddings=embeddings, documents=contents, metadatas=metadatas)
+        state["sparse"].add(ids, contents, metadatas)
+
+    flush_size = max(1, args.flush_size)
+    buf = []
+    # Files whose chunks are all in buf but not yet flushed: recorded in the manifest after the flush
+    waiting = []
+    t0 = time.time()
+
+    def flush_and_commit():
+        nonlocal buf, waiting, total_chunks, files_done
+        flush(buf)
+        total_chunks += len(buf)
+        buf = []
+        if state["coll"] is None:
+            return  # full run without a single chunk: the index and manifest were never reset, leave them alone
+        for path, entry in waiting:
+            manifest[str(path)] = entry
+            files_done += 1
+        if waiting:
+            save_index_manifest(index_dir, manifest)
+        waiting = []
+        elapsed = max(time.time() - t0, 1e-6)
+        print(f"\r  Indexed {total_chunks} chunks, {files_done}/{len(to_index)} files ({total_chunks / elapsed:.1f} chunks/s)", end="", flush=True)
+
+    workers = args.workers if args.workers > 0 else (os.cpu_count() or 1)
+    for path, chunks in parse_files(to_index, args.chunk_tokens, args.chunk_strategy, workers, args.parse_timeout, path_depth):
+        n = 0
+        started = False
+        seen = set()
+        try:
+            for c in chunks:
+                if not started:
+                    begin_file(path)
+                    started = True
+                buf.append(c)
+                seen.add(chunk_id(c["content"]))
+                n += 1
+                if len(buf) >= flush_size:
+                    flush_and_commit()
+            if not started and args.incremental:
+                begin_file(path)  # file is now empty: still drop its old chunks
+                started = True
+            if started:
+                end_file(path, seen)
+            waiting.append((path, entries[path]))  # files without chunks too, so --incremental skips them
+            print(f"\r  Loaded {path.name}: {n} chunks" + " " * 20)
+        except Exception as e:
+            print(f"\r  Error {path}: {e}")
+            # Drop this file's unflushed chunks; it stays out of the manifest and is retried next run
+            buf = [c for c in buf if c["metadata"].get("source") != str(path)]
+            for i in stored_by_file.pop(path, ()):
+                stored.pop(i, None)
+    if to_index:
+        flush_and_commit()
+        print()
+    if not total_chunks and not removed:
+        return {"error": "No chunks produced."}
+    ctx.set_sparse(state["sparse"])
+    optimize = getattr(state["coll"], "optimize", None)
+    if optimize is not None:
+        optimize(args.ivf_lists)  # NumpyStore: compact replaced rows, (re)build the IVF partition
+    if cache and to_index:
+        st = cache.stats()
+        hits, misses = st["hits"] - cache_before[0], st["misses"] - cache_before[1]
+        st.update(hits=hits, misses=misses, hit_rate=round(hits / (hits + misses), 4) if hits + misses else 0.0)
+        print(f"  Embedding cache: {hits}/{hits + misses} hits ({st['hit_rate'] * 100:.1f}%)")
+        log("embed_cache", st)
+    elapsed = time.time() - t0
+    print(f"  Indexed {total_chunks} chunks." + (f" Removed {removed} file(s)." if removed else ""))
+    if args.incremental and total_chunks:
+        print(f"  Chunks: {counts['added']} added, {counts['kept']} kept, {counts['deleted']} removed")
+    log("index", {"chunks": total_chunks, "files": files_done, "removed": removed, "unchanged": unchanged, **{f"chunks_{k}": v for k, v in counts.items()}, "seconds": round(elapsed, 3)})
+    return {"chunks": total_chunks, "files": files_done, "removed": removed, **{f"chunks_{k}": v for k, v in counts.items()}}
+
+
+CONTEXT_DEADLINE = float(os.environ.get("RAG_CONTEXT_DEADLINE", "30"))   # Seconds for retrieval + web together
+STAGE_WORKERS = int(os.environ.get("RAG_STAGE_WORKERS", "16"))           # Concurrent retrieval/web stages (all requests)
+
+_stage_pool = None
+_stage_pool_lock = threading.Lock()
+
+
+def _stage_executor():
+    """Process-wide pool running the retrieval and web stages of a request side by side."""
+    global _stage_pool
+    with _stage_pool_lock:
+        if _stage_pool is None:
+            from concurrent.futures import ThreadPoolExecutor
+            _stage_pool = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="rag-stage")
+    return _stage_pool
+
+
+def _retrieval_failed(e: Exception) -> list[str]:
+    """Log a failed retrieval stage; the request continues without indexed docs."""
+    log("stage_error", {"stage": "retrieval", "error": str(e)})
+    return []
+
+
+def gather_context(
+    ctx: RagContext, query: str, args, web: bool, docs_required: bool = True,
+) -> tuple[list[str], list[tuple[str, str, str]]]:
+    """Document retrieval and (with `web`) the web stage, concurrently under RAG_CONTEXT_DEADLINE. Returns (docs, web parts).
+
+    A late retrieval raises TimeoutError when `docs_required`, else it is dropped like a failed one.
+    """
+    if not web:
+        with span("retrieval"):
+            try:
+                return retrieve_docs(ctx, query, args), []
+            except Exception as e:
+                return _retrieval_failed(e), []
+    from concurrent.futures import wait
+    end = time.time() + CONTEXT_DEADLINE
+    pool = _stage_executor()
+
+    def retrieval() -> list[str]:
+        with span("retrieval"):
+            return retrieve_docs(ctx, query, args)
+
+    def web_stage() -> list[tuple[str, str, str]]:
+        with span("web"):
+            return web_context_parts(query, deadline=min(WEB_DEADLINE, max(0.0, end - time.time())))
+
+    docs_f = pool.submit(contextvars.copy_context().run, retrieval)
+    web_f = pool.submit(contextvars.copy_context().run, web_stage)
+    wait([docs_f, web_f], timeout=max(0.0, end - time.time()))
+    docs = []
+    if not docs_f.done():
+        log("stage_timeout", {"stage": "retrieval", "deadline_s": CONTEXT_DEADLINE})
+        if docs_required:
+            raise TimeoutError(f"Retrieval did not finish within {CONTEXT_DEADLINE:.0f}s (RAG_CONTEXT_DEADLINE)")
+    else:
+        try:
+            docs = docs_f.result()
+        except Exception as e:
+            docs = _retrieval_failed(e)
+    web_parts = []
+    if not web_f.done():
+        log("stage_timeout", {"stage": "web", "deadline_s": CONTEXT_DEADLINE})
+    else:
+        try:
+            web_parts = web_f.result()
+        except Exception as e:
+            log("stage_error", {"stage": "web", "error": str(e)})
+    return docs, web_parts
+
+
+def build_messages(system: str, query: str, docs: list[str], web_parts: list, args) -> tuple[list[dict] | None, str, dict]:
+    """Chat messages with the packed context (pack_context sized by context_budget). Returns (messages, context, stats)."""
+    question = f"\n---\n\nQuestion: {query}"
+    with span("context_pack"):
+        context, stats = pack_context(docs, web_parts, context_budget(system + question, args.context_tokens))
+    if not context:
+        return None, "", stats
+    return [
+        {"role": "system", "content": system},
+        {"role": "user", "content": f"Context:\n---\n{context}{question}"},
+    ], context, stats
+
+
+def _semantic_lookup(ctx: RagContext, kind: str, query: str, args) -> tuple[str | None, list[float] | None, tuple | None]:
+    """Semantic cache probe: (namespace, query embedding, (answer, similarity) or None). Namespace None when unavailable."""
+    sem = semantic_cache()
+    if sem is None or args.no_cache:
+        return None, None, None
+    namespace = "|".join([
+        kind, ctx.index_version(), args.model, args.embed_model, f"ctx={NUM_CTX}/{args.context_tokens}",
+        args.filter_source or "", args.filter_type or "", f"web={bool(getattr(args, 'web', False))}",
+    ])
+    try:
+        vec = embed_query(query, args.embed_model)
+    except Exception as e:
+        log("semantic_cache_error", {"error": str(e)})
+        return None, None, None
+    return namespace, vec, sem.get(namespace, vec)
+
+
+def _semantic_hit(kind: str, query: str, hit: tuple, on_token) -> dict:
+    answer, similarity = hit
+    log("semantic_cache_hit", {"kind": kind, "query": query[:100], "similarity": round(similarity, 4)})
+    if on_token:
+        on_token(answer)
+    return {"answer": answer, "citations": parse_citations(answer), "cached": True, "similarity": round(similarity, 4)}
+
+
+@traced
+def run_query(ctx: RagContext, query: str, args, on_token=None) -> dict:
+    """Answer from indexed docs (plus web with args.web), streamed to `on_token` if given. Returns {answer, citations, cached[, stats]} or {error}."""
+    t0 = time.time()
+    cache_key = f"answer|query|{ctx.index_version()}|{args.model}|ctx={NUM_CTX}/{args.context_tokens}|{args.filter_source or ''}|{args.filter_type or ''}|web={args.web}|{query}"
+    if not args.no_cache:
+        cached = cache_get(cache_key)
+        if cached:
+            if on_token:
+                on_token(cached)
+            return {"answer": cached, "citations": parse_citations(cached), "cached": True}
+    sem_ns, sem_vec, hit = _semantic_lookup(ctx, "query", query, args)
+    if hit:
+        return _semantic_hit("query", query, hit, on_token)
+    if args.web:
+        print("  Searching web...", file=sys.stderr)
+    try:
+        final_docs, web_parts = gather_context(ctx, query, args, web=args.web)
+    except TimeoutError as e:
+        return {"error": str(e)}
+    messages, _, pack_stats = build_messages(SYSTEM_PROMPT_WEB if web_parts else SYSTEM_PROMPT, query, final_docs, web_parts, args)
+    if messages is None:
+        return {"error": "No relevant documents in index and no web results. Run: rag index <files> and/or use --web"}
+    stats = {}
+    with span("generation"):
+        answer = ollama_chat(messages, args.model, on_token, stats, chat_num_ctx(args.context_tokens))
+    stats.update(pack_stats)
+    log("query", {"query": query[:100], "has_web": bool(web_parts), "stream": on_token is not None, "latency_total_ms": (time.time() - t0) * 1000, **stats, "spans": current_spans()})
+    if not args.no_cache:
+        cache_set(cache_key, answer)
+        if sem_ns:
+            semantic_cache().put(sem_ns, sem_vec, answer)
+    return {"answer": answer, "citations": parse_citations(answer), "cached": False, "stats": stats}
+
+
+@traced
+def run_research(ctx: RagContext, query: str, args, on_token=None) -> dict:
+    """Web research merged with indexed docs, streamed to `on_token` if given. Returns {answer, citations}, {context} with context_only, or {error}."""
+    t0 = time.time()
+    cache_key = f"answer|research|{ctx.index_version()}|{args.model}|ctx={NUM_CTX}/{args.context_tokens}|{args.filter_source or ''}|{args.filter_type or ''}|{query}"
+    if not args.no_cache and not args.context_only:
+        cached = cache_get(cache_key)
+        if cached:
+            if on_token:
+                on_token(cached)
+            return {"answer": cached, "citations": parse_citations(cached), "cached": True}
+    sem_ns, sem_vec, hit = (None, None, None) if args.context_only else _semantic_lookup(ctx, "research", query, args)
+    if hit:
+        return _semantic_hit("research", query, hit, on_token)
+    if not args.context_only:
+        print("  Searching web...", file=sys.stderr)
+    final_docs, web_parts = gather_context(ctx, query, args, web=True, docs_required=False)
+    messages, context, pack_stats = build_messages(SYSTEM_PROMPT_WEB, query, final_docs, web_parts, args)
+    if messages is None:
+        return {"error": "No web results found. Check your internet connection."}
+    if args.context_only:
+        log("research", {"query": query[:100], "context_only": True, "latency_total_ms": (time.time() - t0) * 1000, **pack_stats, "spans": current_spans()})
+        return {"context": context}
+    stats = {}
+    with span("generation"):
+        answer = ollama_chat(messages, args.model, on_token, stats, chat_num_ctx(args.context_tokens))
+    stats.update(pack_stats)
+    log("research", {"query": query[:100], "stream": on_token is not None, "latency_total_ms": (time.time() - t0) * 1000, **stats, "spans": current_spans()})
+    if not args.no_cache:
+        cache_set(cache_key, answer)
+        if sem_ns:
+            semantic_cache().put(sem_ns, sem_vec, answer)
+    return {"answer": answer, "citations": parse_citations(answer), "cached": False, "stats": stats}
+
+
+# --- Watch mode (`rag watch`) ---
+WATCH_DEBOUNCE = float(os.environ.get("RAG_WATCH_DEBOUNCE", "1.0"))     # Quiet seconds before a batch is reindexed
+WATCH_MAX_DELAY = float(os.environ.get("RAG_WATCH_MAX_DELAY", "10"))    # Reindex at least this often while changes keep coming
+WATCH_POLL_INTERVAL = 2.0                                               # Stat scan interval without inotify
+
+# inotify(7) event bits
+IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x8, 0x40, 0x80
+IN_CREATE, IN_DELETE, IN_DELETE_SELF = 0x100, 0x200, 0x400
+IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+
+
+class Inotify:
+    """Minimal inotify wrapper over ctypes watching directories (Linux only; raises OSError elsewhere)."""
+
+    MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            init = self._libc.inotify_init1
+        except (OSError, AttributeError) as e:
+            raise OSError(f"inotify unavailable: {e}") from e
+        self.fd = init(os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._dirs = {}  # watch descriptor -> directory
+
+    def add(self, directory: Path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(str(directory)), self.MASK)
+        if wd >= 0:
+            self._dirs[wd] = Path(directory)
+
+    def add_tree(self, root: Path, exclude: list[str] | None = None):
+        """Watch `root` and its subdirectories, skipping excluded ones (see path_selected)."""
+        self.add(root)
+        for dirpath, dirnames, _ in os.walk(root):
+            rel_dir = os.path.relpath(dirpath, root)
+            rel_dir = "" if rel_dir == "." else rel_dir
+            dirnames[:] = [d for d in dirnames if path_selected(os.path.join(rel_dir, d), ["*"], exclude)]
+            for d in dirnames:
+                self.add(Path(dirpath) / d)
+
+    def read(self, timeout: float | None) -> list[tuple[Path, int]]:
+        """(path, mask) events, waiting up to `timeout` seconds (None = until one arrives)."""
+        import select
+        import struct
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        buf = os.read(self.fd, 64 * 1024)
+        events = []
+        i = 0
+        while i + 16 <= len(buf):
+            wd, mask, _cookie, length = struct.unpack_from("iIII", buf, i)
+            name = buf[i + 16:i + 16 + length].rstrip(b"\0")
+            i += 16 + length
+            if mask & IN_Q_OVERFLOW:
+                events.append((Path("/"), mask))
+                continue
+            directory = self._dirs.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            events.append((directory / os.fsdecode(name) if name else directory, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+def scan_changes(paths: list[str], manifest: dict, include: list[str] | None = None, exclude: list[str] | None = None) -> set[Path]:
+    """Files under `paths` that are new, changed (size/mtime/inode) or deleted relative to the manifest."""
+    files, roots = expand_index_paths(paths, include, exclude)
+    changed = {p for p in files if not stat_unchanged(p, manifest.get(str(p)))}
+    listed = {str(p) for p in files}
+    for root in roots:
+        prefix = str(root) + os.sep
+        changed.update(Path(src) for src in manifest if src.startswith(prefix) and src not in listed)
+    return changed
+
+
+def run_watch(ctx: RagContext, args):
+    """`rag watch`: index `args.paths` incrementally, then reindex touched files in debounced batches until Ctrl+C."""
+    args.incremental = True
+    files, roots = expand_index_paths(args.paths, args.include, args.exclude)
+    explicit = {p for p in files if not any(p.is_relative_to(r) for r in roots)}
+    with ctx.write_lock:
+        run_index(ctx, args.paths, args)
+    try:
+        notifier = Inotify()
+    except OSError as e:
+        notifier = None
+        print(f"  {e}; polling every {WATCH_POLL_INTERVAL:.0f}s", file=sys.stderr)
+    if notifier is not None:
+        for root in roots:
+            notifier.add_tree(root, args.exclude)
+        for d in {p.parent for p in explicit}:
+            notifier.add(d)
+
+    def selected(path: Path, include: list[str] | None) -> bool:
+        """Is `path` inside a watched directory and not filtered out (include=["*"] for directories)?"""
+        for root in roots:
+            if path.is_relative_to(root) and path != root:
+                return path_selected(str(path.relative_to(root)), include, args.exclude)
+        return False
+
+    def changes(events: list[tuple[Path, int]]) -> set[Path]:
+        out = set()
+        for path, mask in events:
+            if mask & IN_Q_OVERFLOW:
+                return scan_changes(args.paths, load_index_manifest(ctx.index_dir), args.include, args.exclude)
+            if mask & IN_ISDIR:
+                if not selected(path, ["*"]):
+                    continue
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    notifier.add_tree(path, args.exclude)
+                    out.update(expand_index_paths([str(path)], args.include, args.exclude)[0])
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    prefix = str(path) + os.sep
+                    out.update(Path(s) for s in load_index_manifest(ctx.index_dir) if s.startswith(prefix))
+            elif path in explicit or selected(path, args.include):
+                out.add(path)
+        return out
+
+    print(f"Watching {len(roots)} director{'y' if len(roots) == 1 else 'ies'} and {len(explicit)} file(s) (Ctrl+C to stop)")
+    pending, first, last = set(), 0.0, 0.0
+    try:
+        while True:
+            if notifier is not None:
+                found = changes(notifier.read(args.debounce if pending else None))
+            else:
+                time.sleep(WATCH_POLL_INTERVAL)
+                found = scan_changes(args.paths, load_index_manifest(ctx.index_dir), args.include, args.exclude)
+            now = time.time()
+            if found - pending:
+                if not pending:
+                    first = now
+                pending |= found
+                last = now
+            if pending and (now - last >= args.debounce or now - first >= WATCH_MAX_DELAY):
+                batch = sorted(pending)
+                pending.clear()
+                t0 = time.time()
+                with ctx.write_lock:
+                    result = run_index(ctx, [str(p) for p in batch], args)
+                log("watch_batch", {"paths": len(batch), **result, "seconds": round(time.time() - t0, 3)})
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if notifier is not None:
+            notifier.close()
+
+
+# --- Daemon (`rag serve`) ---
+SERVE_HOST = os.environ.get("RAG_SERVE_HOST", "127.0.0.1")
+SERVE_PORT = int(os.environ.get("RAG_SERVE_PORT", "41437"))
+# Request JSON keys that may override the daemon's CLI defaults (argparse dest names)
+SERVE_OPTION_KEYS = (
+    "model", "embed_model", "incremental", "no_cache", "filter_source", "filter_type", "web",
+    "context_only", "no_rerank", "chunk_tokens", "chunk_strategy", "expand_query",
+    "embed_batch_size", "embed_concurrency", "flush_size",
+    "workers", "parse_timeout", "path_depth", "include", "exclude",
+    "vector_store", "vector_dtype", "ivf_lists", "context_tokens",
+)
+
+
+def stream_final_event(result: dict) -> dict:
+    """Last NDJSON event of a streamed query/research: done (answer, citations, stats), context, or error."""
+    if "error" in result:
+        return {"type": "error", "error": result["error"]}
+    if "context" in result:
+        return {"type": "context", "context": result["context"]}
+    return {"type": "done", **result}
+
+
+def serve(ctx: RagContext, args):
+    """JSON API over local HTTP: POST /query, /research, /index; GET /health."""
+    import argparse
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    actions = {a.dest: a for a in build_parser()._actions if a.dest in SERVE_OPTION_KEYS}
+
+    def option_error(action, value) -> str | None:
+        """Why `value` is not valid for the CLI option behind `action`, or None."""
+        if value is None and action.default is None:
+            return None
+        if action.nargs == 0:  # store_true flag
+            ok, want = isinstance(value, bool), "a boolean"
+        elif action.type in (int, float):
+            ok = isinstance(value, (int, float) if action.type is float else int) and not isinstance(value, bool)
+            want = "a number" if action.type is float else "an integer"
+        elif isinstance(action, argparse._AppendAction):
+            ok, want = isinstance(value, list) and all(isinstance(v, str) for v in value), "a list of strings"
+        else:
+            ok, want = isinstance(value, str), "a string"
+        if ok and action.choices and value not in action.choices:
+            ok, want = False, "one of " + ", ".join(action.choices)
+        return None if ok else f"Invalid {action.dest}: expected {want}"
+
+    def request_args(body: dict):
+        """Options for one request (CLI args overridden by body keys). Returns (opts, error)."""
+        opts = argparse.Namespace(**vars(args))
+        for k in SERVE_OPTION_KEYS:
+            if k in body:
+                error = option_error(actions[k], body[k])
+                if error:
+                    return None, error
+                setattr(opts, k, body[k])
+        return opts, None
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, code: int, payload: dict):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *a):
+            pass
+
+        def _stream(self, route: str, query: str, opts):
+            """NDJSON response: token events while generating, then one done/context/error event."""
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = True
+
+            def emit(event: dict):
+                self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+                self.wfile.flush()
+
+            t0 = time.time()
+            run = run_query if route == "/query" else run_research
+            try:
+                result = run(ctx, query, opts, on_token=lambda text: emit({"type": "token", "text": text}))
+                emit(stream_final_event(result))
+                status = 422 if "error" in result else 200  # as the non-streaming response
+            except (BrokenPipeError, ConnectionResetError):
+                return
+            except Exception as e:
+                log("serve_error", {"route": route, "error": str(e)})
+                emit({"type": "error", "error": str(e)})
+                status = 500
+            latency = (time.time() - t0) * 1000
+            metrics.observe(f"request_{route.strip('/')}", latency)
+            metrics.inc("rag_requests_total", route=route, status=status)
+            log("serve_request", {"route": route, "stream": True, "latency_ms": latency})
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/metrics":
+                data = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            elif self.path.rstrip("/") == "/health":
+                cache = embedding_cache()
+                wcache = web_cache()
+                self._send(200, {
+                    "ok": True, "index_dir": str(ctx.index_dir),
+                    "embed_cache": cache.stats() if cache else None,
+                    "web_cache": wcache.stats() if wcache else None,
+                    "stages": metrics.snapshot(),
+                })
+            else:
+                self._send(404, {"error": "Not found"})
+
+        def do_POST(self):
+            route = self.path.rstrip("/")
+            try:
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+            except Exception:
+                self._send(400, {"error": "Invalid JSON body"})
+                return
+            opts, error = request_args(body)
+            if error:
+                metrics.inc("rag_requests_total", route=route, status=400)
+                self._send(400, {"error": error})
+                return
+            t0 = time.time()
+            try:
+                if route in ("/query", "/research"):
+                    query = (body.get("query") or body.get("q") or "").strip()
+                    if not query:
+                        self._send(400, {"error": "Missing query"})
+                        return
+                    if body.get("stream"):
+                        self._stream(route, query, opts)
+                        return
+                    result = run_query(ctx, query, opts) if route == "/query" else run_research(ctx, query, opts)
+                elif route == "/index":
+                    paths = body.get("paths") or []
+                    if not paths:
+                        self._send(400, {"error": "Missing paths"})
+                        return
+                    with ctx.write_lock:
+                        result = run_index(ctx, paths, opts)
+                else:
+                    self._send(404, {"error": "Not found"})
+                    return
+            except Exception as e:
+                log("serve_error", {"route": route, "error": str(e)})
+                metrics.inc("rag_requests_total", route=route, status=500)
+                self._send(500, {"error": str(e)})
+                return
+            latency = (time.time() - t0) * 1000
+            metrics.observe(f"request_{route.strip('/')}", latency)
+            metrics.inc("rag_requests_total", route=route, status=422 if "error" in result else 200)
+            log("serve_request", {"route": route, "latency_ms": latency})
+            self._send(422 if "error" in result else 200, result)
+
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    server.daemon_threads = True
+    # Pre-warm heavy handles so the first request does not pay for them
+    try:
+        ctx.collection()
+        ctx.sparse()
+    except Exception as e:
+        print(f"  Index not available yet: {e}", file=sys.stderr)
+    if not args.no_rerank:
+        _get_reranker()
+    print(f"RAG serve listening on http://{args.host}:{args.port} (index: {ctx.index_dir})")
+    log("serve_start", {"host": args.host, "port": args.port})
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
 
 
 # --- Main ---
-def main():
+def build_parser():
     import argparse
     p = argparse.ArgumentParser(description="RAG – index docs and answer questions")
-    p.add_argument("command", choices=["index", "query", "eval", "research"], help="index, query, eval, or research")
+    p.add_argument("command", choices=["index", "query", "eval", "research", "serve", "watch"], help="index, query, eval, research, serve, or watch")
     p.add_argument("paths", nargs="*", help="paths or query")
-    p.add_argument("--index-dir", default=str(DEFAULT_INDEX_DIR), help="Chroma index dir")
+    p.add_argument("--index-dir", default=str(DEFAULT_INDEX_DIR), help="Index dir (vector store + BM25)")
     p.add_argument("--model", default="llama3.2", help="Ollama model")
     p.add_argument("--embed-model", default="nomic-embed-text", help="Embedding model")
     p.add_argument("--incremental", action="store_true", help="Only reindex changed files")
@@ -624,231 +3703,140 @@ def main():
     p.add_argument("--no-rerank", action="store_true", help="Disable cross-encoder reranking (use RRF only)")
     p.add_argument("--chunk-tokens", type=int, default=0, help="Chunk size in tokens (256-512). 0=use chars")
     p.add_argument("--chunk-strategy", choices=["recursive", "semantic"], default="recursive", help="Chunking strategy")
+    p.add_argument("--embed-batch-size", type=int, default=EMBED_BATCH_SIZE, help="index: texts per Ollama /api/embed request")
+    p.add_argument("--embed-concurrency", type=int, default=EMBED_CONCURRENCY, help="index: embedding requests in flight")
+    p.add_argument("--flush-size", type=int, default=INDEX_FLUSH_SIZE, help="index: chunks embedded and written per batch")
+    p.add_argument("--workers", type=int, default=1, help="index: processes for parsing/chunking (0 = all cores, 1 = in-process)")
+    p.add_argument("--parse-timeout", type=float, default=PARSE_TIMEOUT, help="index: seconds per file before a worker is abandoned (--workers > 1)")
+    p.add_argument("--include", action="append", help="index/watch: glob for file names inside directories (repeatable; default: supported extensions)")
+    p.add_argument("--exclude", action="append", help="index/watch: glob for paths to skip inside directories (repeatable; hidden files, node_modules, __pycache__ always)")
+    p.add_argument("--debounce", type=float, default=WATCH_DEBOUNCE, help="watch: seconds without changes before a batch is reindexed (RAG_WATCH_DEBOUNCE)")
+    p.add_argument("--path-depth", type=int, default=PATH_DEPTH, help="index: directory levels stored per chunk for --filter-source (0 = off; RAG_PATH_DEPTH)")
+    p.add_argument("--vector-store", choices=["chroma", "numpy"], help="index: vector backend for a full rebuild (default: the index's current one, else RAG_VECTOR_STORE)")
+    p.add_argument("--vector-dtype", choices=["int8", "float16"], default=VECTOR_DTYPE, help="index: stored vector precision for --vector-store numpy (RAG_VECTOR_DTYPE)")
+    p.add_argument("--ivf-lists", type=int, default=IVF_LISTS, help="index: IVF partitions for --vector-store numpy (0 = exact search; RAG_IVF_LISTS)")
+    p.add_argument("--stream", action="store_true", help="query/research: print the answer as it is generated")
+    p.add_argument("--stream-format", choices=["text", "ndjson"], default="text", help="Streaming output: text, or NDJSON events for front ends (implies --stream)")
+    p.add_argument("--context-tokens", type=int, default=CONTEXT_TOKENS, help="query/research: cap on packed context tokens, also sizes Ollama's num_ctx (0 = fill RAG_NUM_CTX, no limit when unset; RAG_CONTEXT_TOKENS)")
     p.add_argument("--expand-query", action="store_true", help="Expand query with LLM alternatives for better recall")
     p.add_argument("--eval-ares", action="store_true", help="Use ARES for eval (pip install ares-ai)")
-    args = p.parse_args()
+    p.add_argument("--host", default=SERVE_HOST, help="serve: bind address (RAG_SERVE_HOST)")
+    p.add_argument("--port", type=int, default=SERVE_PORT, help="serve: port (RAG_SERVE_PORT)")
+    return p
+
 
-    index_dir = Path(args.index_dir).expanduser()
-    index_dir.mkdir(parents=True, exist_ok=True)
+def _print_answer(result: dict, citations: bool):
+    print(result["answer"])
+    if citations:
+        cites = result.get("citations") or []
+        if cites:
+            print("\n--- Cited sources:", ", ".join(cites))
 
-    # ChromaDB only needed for index/query/eval; research can run web-only without it
-    def _chroma_client():
-        import chromadb
-        from chromadb.config import Settings
-        return chromadb.PersistentClient(path=str(index_dir), settings=Settings(anonymized_telemetry=False))
 
-    client = None
+def _stream_handler(fmt: str):
+    """on_token callback for CLI streaming: raw text, or one NDJSON token event per line."""
+    def on_token(text: str):
+        if fmt == "ndjson":
+            print(json.dumps({"type": "token", "text": text}), flush=True)
+        else:
+            print(text, end="", flush=True)
+    return on_token
+
+
+def _finish_stream(result: dict, args):
+    """Print the end of a streamed answer (final NDJSON event, or newline + citations); exit 1 on error."""
+    if args.stream_format == "ndjson":
+        print(json.dumps(stream_final_event(result)), flush=True)
+    elif "error" in result:
+        print(result["error"])
+    elif "context" in result:
+        print(result["context"])
+    else:
+        print()
+        if args.citations and result.get("citations"):
+            print("\n--- Cited sources:", ", ".join(result["citations"]))
+    if "error" in result:
+        sys.exit(1)
+
+
+def main():
+    args = build_parser().parse_args()
+    if args.stream_format == "ndjson":
+        args.stream = True
+    ctx = RagContext(Path(args.index_dir))
+    index_dir = ctx.index_dir
 
     # --- INDEX ---
     if args.command == "index":
-        client = _chroma_client()
         if not args.paths:
-            print("Usage: rag index <file.pdf> [file2.docx ...] [--incremental]")
+            print("Usage: rag index <file.pdf | dir> [more ...] [--incremental] [--include GLOB] [--exclude GLOB]")
             sys.exit(1)
-        manifest = load_index_manifest(index_dir)
-        to_index = []
-        for fp in args.paths:
-            path = Path(fp).expanduser().resolve()
-            if not path.exists():
-                print(f"  Skip {path}: not found")
-                continue
-            if args.incremental:
-                h = file_hash(path)
-                if manifest.get(str(path)) == h:
-                    print(f"  Skip {path}: unchanged")
-                    continue
-            to_index.append(path)
-        if not to_index:
-            print("Nothing to index.")
+        result = run_index(ctx, args.paths, args)
+        if result.get("message"):
+            print(result["message"])
             sys.exit(0)
-        use_tokens = args.chunk_tokens > 0
-        chunk_size = args.chunk_tokens if use_tokens else CHUNK_SIZE
-        chunk_overlap = int(chunk_size * CHUNK_OVERLAP_RATIO)
-        semantic = args.chunk_strategy == "semantic"
-        all_chunks = []
-        for path in to_index:
-            try:
-                parts = load_document(path)
-                n = 0
-                for text, meta in parts:
-                    c = chunk_text(
-                        text,
-                        meta["source"],
-                        meta["file_type"],
-                        meta.get("page"),
-                        meta.get("section"),
-                        chunk_size=chunk_size,
-                        chunk_overlap=chunk_overlap,
-                        use_tokens=use_tokens,
-                        semantic=semantic,
-                    )
-                    all_chunks.extend(c)
-                    n += len(c)
-                manifest[str(path)] = file_hash(path)
-                print(f"  Loaded {path.name}: {n} chunks")
-            except Exception as e:
-                print(f"  Error {path}: {e}")
-        if not all_chunks:
+        if "error" in result:
             sys.exit(1)
-        ids = [f"chunk_{hashlib.md5(c['content'].encode()).hexdigest()[:12]}" for c in all_chunks]
-        contents = [c["content"] for c in all_chunks]
-        metadatas = [c["metadata"] for c in all_chunks]
-        print("  Embedding...")
-        embeddings = [get_ollama_embedding(c["content"], args.embed_model) for c in all_chunks]
-        try:
-            coll = client.get_collection("rag_docs")
-            if args.incremental:
-                for path in to_index:
-                    try:
-                        coll.delete(where={"source": str(path)})
-                    except Exception:
-                        pass
-            else:
-                client.delete_collection("rag_docs")
-                coll = client.create_collection("rag_docs", metadata={"hnsw:space": "cosine"})
-        except Exception:
-            coll = client.create_collection("rag_docs", metadata={"hnsw:space": "cosine"})
-        coll.add(ids=ids, embeddings=embeddings, documents=contents, metadatas=metadatas)
-        save_index_manifest(index_dir, manifest)
-        print(f"  Indexed {len(all_chunks)} chunks.")
-        log("index", {"chunks": len(all_chunks), "files": len(to_index)})
 
     # --- QUERY ---
     elif args.command == "query":
-        client = _chroma_client()
         query = " ".join(args.paths) if args.paths else input("Query: ").strip()
         if not query:
             sys.exit(1)
-        cache_key = f"{query}|{args.filter_source or ''}|{args.filter_type or ''}|web={args.web}"
-        if not args.no_cache:
-            cached = cache_get(cache_key)
-            if cached:
-                print(cached)
-                sys.exit(0)
-        doc_context = ""
-        try:
-            coll = client.get_or_create_collection("rag_docs", metadata={"hnsw:space": "cosine"})
-            if coll.count() > 0:
-                where = {}
-                if args.filter_source:
-                    where["source"] = {"$regex": f"^{re.escape(args.filter_source)}"}
-                if args.filter_type:
-                    where["file_type"] = args.filter_type
-                where = where if where else None
-                t0 = time.time()
-                use_rerank = not args.no_rerank
-                if args.expand_query:
-                    final_docs = retrieve_with_expansion(coll, query, args.embed_model, where, use_rerank, expand_query_fn=expand_query, model=args.model)
-                else:
-                    final_docs = retrieve_hybrid(coll, query, args.embed_model, where, use_rerank)
-                doc_context = "\n\n".join(f"[doc {i+1}] {d}" for i, d in enumerate(final_docs)) if final_docs else ""
-        except Exception:
-            pass
-        web_context = ""
-        if args.web:
-            print("  Searching web...", file=sys.stderr)
-            web_context = build_web_context(query)
-        if not doc_context and not web_context:
-            print("No relevant documents in index and no web results. Run: rag index <files> and/or use --web")
+        if args.stream:
+            _finish_stream(run_query(ctx, query, args, on_token=_stream_handler(args.stream_format)), args)
+            sys.exit(0)
+        result = run_query(ctx, query, args)
+        if "error" in result:
+            print(result["error"])
             sys.exit(1)
-        context_parts = []
-        if doc_context:
-            context_parts.append("Documents:\n" + doc_context)
-        if web_context:
-            context_parts.append("Web search results:\n" + web_context)
-        full_context = "\n\n---\n\n".join(context_parts)
-        sys_prompt = SYSTEM_PROMPT_WEB if web_context else SYSTEM_PROMPT
-        messages = [
-            {"role": "system", "content": sys_prompt},
-            {"role": "user", "content": f"Context:\n---\n{full_context}\n---\n\nQuestion: {query}"},
-        ]
-        t0 = time.time()
-        answer = ollama_chat(messages, args.model)
-        log("query", {"query": query[:100], "has_web": bool(web_context), "latency_total_ms": (time.time() - t0) * 1000})
-        if not args.no_cache:
-            cache_set(cache_key, answer)
-        print(answer)
-        if args.citations:
-            cites = parse_citations(answer)
-            if cites:
-                print("\n--- Cited sources:", ", ".join(cites))
+        if result.get("cached"):
+            print(result["answer"])
+            sys.exit(0)
+        _print_answer(result, args.citations)
 
     # --- RESEARCH (web-only or web + RAG) ---
     elif args.command == "research":
         query = " ".join(args.paths) if args.paths else input("Research query: ").strip()
         if not query:
             sys.exit(1)
-        cache_key = f"research|{query}|{args.filter_source or ''}|{args.filter_type or ''}"
-        if not args.no_cache:
-            cached = cache_get(cache_key)
-            if cached:
-                print(cached)
-                sys.exit(0)
-        context_parts = []
-        try:
-            client = _chroma_client()
-            coll = client.get_or_create_collection("rag_docs", metadata={"hnsw:space": "cosine"})
-            if coll.count() > 0:
-                where = {}
-                if args.filter_source:
-                    where["source"] = {"$regex": f"^{re.escape(args.filter_source)}"}
-                if args.filter_type:
-                    where["file_type"] = args.filter_type
-                where = where if where else None
-                use_rerank = not args.no_rerank
-                if args.expand_query:
-                    final_docs = retrieve_with_expansion(coll, query, args.embed_model, where, use_rerank, expand_query_fn=expand_query, model=args.model)
-                else:
-                    final_docs = retrieve_hybrid(coll, query, args.embed_model, where, use_rerank)
-                if final_docs:
-                    context_parts.append("Documents:\n" + "\n\n".join(f"[doc {i+1}] {d}" for i, d in enumerate(final_docs)))
-        except Exception:
-            pass
-        if not args.context_only:
-            print("  Searching web...", file=sys.stderr)
-        web_context = build_web_context(query)
-        if web_context:
-            context_parts.append("Web search results:\n" + web_context)
-        if not context_parts:
-            print("No web results found. Check your internet connection.")
+        if args.stream:
+            _finish_stream(run_research(ctx, query, args, on_token=_stream_handler(args.stream_format)), args)
+            sys.exit(0)
+        result = run_research(ctx, query, args)
+        if "error" in result:
+            print(result["error"])
             sys.exit(1)
-        full_context = "\n\n---\n\n".join(context_parts)
-        if args.context_only:
-            log("research", {"query": query[:100], "context_only": True})
-            print(full_context)
+        if "context" in result:
+            print(result["context"])
+        elif result.get("cached"):
+            print(result["answer"])
+            sys.exit(0)
         else:
-            messages = [
-                {"role": "system", "content": SYSTEM_PROMPT_WEB},
-                {"role": "user", "content": f"Context:\n---\n{full_context}\n---\n\nQuestion: {query}"},
-            ]
-            answer = ollama_chat(messages, args.model)
-            log("research", {"query": query[:100]})
-            if not args.no_cache:
-                cache_set(cache_key, answer)
-            print(answer)
-        if args.citations:
-            cites = parse_citations(answer)
-            if cites:
-                print("\n--- Cited sources:", ", ".join(cites))
+            _print_answer(result, args.citations)
+
+    # --- SERVE (long-running daemon) ---
+    elif args.command == "serve":
+        serve(ctx, args)
+
+    # --- WATCH (keep the index current) ---
+    elif args.command == "watch":
+        if not args.paths:
+            print("Usage: rag watch <dir | file> [more ...] [--include GLOB] [--exclude GLOB] [--debounce 1.0]")
+            sys.exit(1)
+        run_watch(ctx, args)
 
     # --- EVAL ---
     elif args.command == "eval":
-        client = _chroma_client()
         eval_path = Path(args.eval_file) if args.eval_file else Path("eval.jsonl")
         if not eval_path.exists():
             print(f"Eval file not found: {eval_path}")
             print("Create eval.jsonl with one JSON object per line: {\"question\": \"...\", \"expected\": \"...\"}")
             sys.exit(1)
-        coll = client.get_or_create_collection("rag_docs", metadata={"hnsw:space": "cosine"})
+        coll = ctx.collection()
         if coll.count() == 0:
             print("Index is empty. Run: rag index <files> first.")
             sys.exit(1)
-        where = {}
-        if args.filter_source:
-            where["source"] = {"$regex": f"^{re.escape(args.filter_source)}"}
-        if args.filter_type:
-            where["file_type"] = args.filter_type
-        where = where if where else None
         lines = eval_path.read_text().strip().split("\n")
         results = []
         for i, line in enumerate(lines):
@@ -858,32 +3846,27 @@ def main():
             q = row.get("question", row.get("q", ""))
             if not q:
                 continue
-            use_rerank = not args.no_rerank
-            if args.expand_query:
-                final_docs = retrieve_with_expansion(coll, q, args.embed_model, where, use_rerank, expand_query_fn=expand_query, model=args.model)
-            else:
-                final_docs = retrieve_hybrid(coll, q, args.embed_model, where, use_rerank)
-            context = "\n\n".join(final_docs) if final_docs else ""
-            eval_context = context
-            messages = [
+            final_docs = retrieve_docs(ctx, q, args)
+            messages, eval_context, _ = build_messages(SYSTEM_PROMPT, q, final_docs, [], args)
+            messages = messages or [
                 {"role": "system", "content": SYSTEM_PROMPT},
-                {"role": "user", "content": f"Context:\n---\n{context}\n---\n\nQuestion: {q}"},
+                {"role": "user", "content": f"Context:\n---\n\n---\n\nQuestion: {q}"},
             ]
             try:
-                ans = ollama_chat(messages, args.model)
+                ans = ollama_chat(messages, args.model, num_ctx=chat_num_ctx(args.context_tokens))
                 expected = row.get("expected", row.get("expected_answer", ""))
                 cites = parse_citations(ans)
-                metrics = {}
+                eval_scores = {}
                 if expected:
-                    metrics["has_expected"] = True
+                    eval_scores["has_expected"] = True
                     exp_lower = expected.lower()
                     ans_lower = ans.lower()
                     relevance = 1.0 if any(w in ans_lower for w in exp_lower.split() if len(w) > 3) else 0.0
-                    metrics["answer_relevance"] = relevance
-                metrics["citations_count"] = len(cites)
+                    eval_scores["answer_relevance"] = relevance
+                eval_scores["citations_count"] = len(cites)
                 results.append({
                     "question": q, "answer": ans, "expected": expected,
-                    "citations": cites, "metrics": metrics, "context": eval_context,
+                    "citations": cites, "metrics": eval_scores, "context": eval_context,
                 })
             except Exception as e:
                 results.append({"question": q, "error": str(e)})
@@ -897,9 +3880,9 @@ def main():
             for r in results:
                 if "error" not in r:
                     q = r.get("question", "").replace("\t", " ").replace("\n", " ")
-                    ctx = (r.get("context", "") or "").replace("\t", " ").replace("\n", " ")
+                    ares_ctx = (r.get("context", "") or "").replace("\t", " ").replace("\n", " ")
                     ans = (r.get("answer", "") or "").replace("\t", " ").replace("\n", " ")
-                    lines.append(f"{q}\t{ctx}\t{ans}")
+                    lines.append(f"{q}\t{ares_ctx}\t{ans}")
             ares_tsv.write_text("\n".join(lines), encoding="utf-8")
             print(f"ARES-compatible TSV (for ares-ai): {ares_tsv}")
             print("  pip install ares-ai  # then use ARES docs for full eval")
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Chunking benchmark – token-based splitting (--chunk-tokens) throughput.
+Compares rag._recursive_split(use_tokens=True) against the previous splitter,
+which re-tokenized the growing chunk for every candidate part.
+
+Usage: python3 scripts/bench_chunking.py [files...] [--kb 200] [--chunk-tokens 512] [--repeat 3]
+Without files, a synthetic markdown document of --kb kilobytes is used.
+PDF/DOCX/MD files go through load_document like `rag index`.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+from pathlib import Path
+
+RAG_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(RAG_DIR))
+import rag  # noqa: E402
+
+
+def legacy_token_count(text: str, encoding: str = "cl100k_base") -> int:
+    try:
+        import tiktoken
+        enc = tiktoken.get_encoding(encoding)
+        return len(enc.encode(text))
+    except Exception:
+        return max(1, len(text) // 4)
+
+
+def legacy_recursive_split(text: str, separators: list[str], chunk_size: int, overlap: int) -> list[str]:
+    """Previous token-mode _recursive_split, kept verbatim as the baseline."""
+    if legacy_token_count(text) <= chunk_size:
+        return [text] if text.strip() else []
+
+    def fits(a: str, b: str) -> bool:
+        combined = (a + b) if a else b
+        return legacy_token_count(combined) <= chunk_size
+
+    def trim_tail(s: str, limit: int) -> str:
+        try:
+            import tiktoken
+            enc = tiktoken.get_encoding("cl100k_base")
+            toks = enc.encode(s)
+            return enc.decode(toks[-limit:]) if len(toks) > limit else s
+        except Exception:
+            return s[-limit * 4:] if len(s) > limit * 4 else s
+
+    sep = separators[0] if separators else ""
+    if sep:
+        parts = text.split(sep)
+        chunks = []
+        current = ""
+        for i, p in enumerate(parts):
+            add = p if i == 0 else sep + p
+            if fits(current, add):
+                current = (current + add) if current else add
+            else:
+                if current.strip():
+                    chunks.append(current.strip())
+                if legacy_token_count(add) > chunk_size and len(separators) > 1:
+                    sub = legacy_recursive_split(add, separators[1:], chunk_size, overlap)
+                    chunks.extend(sub[:-1] if sub else [])
+                    current = sub[-1] if sub else trim_tail(add, chunk_size - overlap)
+                else:
+                    current = trim_tail(add, chunk_size - overlap) if legacy_token_count(add) > chunk_size - overlap else add
+        if current.strip():
+            chunks.append(current.strip())
+        return chunks
+    step = chunk_size - overlap
+    try:
+        import tiktoken
+        enc = tiktoken.get_encoding("cl100k_base")
+        toks = enc.encode(text)
+        return [enc.decode(toks[i:i + chunk_size]) for i in range(0, len(toks), step)]
+    except Exception:
+        return [text[i:i + chunk_size * 4] for i in range(0, len(text), step * 4)]
+
+
+def synthetic_markdown(kb: int, seed: int = 7) -> str:
+    rnd = random.Random(seed)
+    words = ("retrieval augmented generation index chunk vector lexical ranking fusion model context "
+             "document query embedding latency throughput cache token section paragraph").split()
+    out, size, n = [], 0, 0
+    while size < kb * 1024:
+        n += 1
+        block = [f"## Section {n}", ""]
+        for _ in range(rnd.randint(2, 6)):
+            sentences = [" ".join(rnd.choice(words) for _ in range(rnd.randint(6, 20))).capitalize() + "."
+                         for _ in range(rnd.randint(2, 8))]
+            block.append(" ".join(sentences))
+            block.append("")
+        text = "\n".join(block)
+        out.append(text)
+        size += len(text)
+    return "\n".join(out)
+
+
+def load_sections(paths: list[str], kb: int) -> list[str]:
+    if not paths:
+        return [synthetic_markdown(kb)]
+    sections = []
+    for p in paths:
+        sections.extend(text for text, _ in rag.load_document(Path(p)))
+    return sections
+
+
+def bench(fn, sections: list[str], repeat: int) -> dict:
+    best = None
+    chunks = 0
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        chunks = sum(len(fn(s)) for s in sections)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    chars = sum(len(s) for s in sections)
+    return {"seconds": round(best, 4), "chunks": chunks, "chars_per_s": round(chars / best) if best else None}
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark token-based chunking")
+    p.add_argument("paths", nargs="*", help="Documents to chunk (default: synthetic markdown)")
+    p.add_argument("--kb", type=int, default=200, help="Synthetic document size (KB)")
+    p.add_argument("--chunk-tokens", type=int, default=512)
+    p.add_argument("--repeat", type=int, default=3)
+    p.add_argument("--skip-legacy", action="store_true", help="Only time the current splitter")
+    args = p.parse_args()
+
+    sections = load_sections(args.paths, args.kb)
+    size, overlap = args.chunk_tokens, int(args.chunk_tokens * rag.CHUNK_OVERLAP_RATIO)
+    result = {
+        "input_chars": sum(len(s) for s in sections),
+        "sections": len(sections),
+        "chunk_tokens": size,
+        "tiktoken": rag._get_encoder() is not None,
+        "current": bench(lambda s: rag._recursive_split(s, rag.SEPARATORS, size, overlap, use_tokens=True), sections, args.repeat),
+    }
+    if not args.skip_legacy:
+        result["legacy"] = bench(lambda s: legacy_recursive_split(s, rag.SEPARATORS, size, overlap), sections, args.repeat)
+        if result["current"]["seconds"]:
+            result["speedup"] = round(result["legacy"]["seconds"] / result["current"]["seconds"], 1)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+RAG pipeline benchmark – in-process retrieval / query load with per-stage percentiles.
+
+Builds a synthetic corpus, indexes it, warms up, then drives `retrieve_docs`
+(--target retrieval) or `run_query` (--target query, includes generation)
+under closed-loop (N workers back to back) or open-loop (fixed arrival rate)
+load. By default a local stub Ollama (scripts/stub_ollama.py) serves
+embeddings and chat, so runs are deterministic and need no model.
+
+All RAG state (index, caches, rag.log) lives in --work-dir, never in ~/.config.
+Prints JSON (also written with --output); --compare prints per-stage deltas
+against a previous result file.
+
+Usage:
+  python3 scripts/bench_rag.py                                   # 200 docs, closed loop, 4 workers
+  python3 scripts/bench_rag.py --target query --mode open --rate 20 --duration 30
+  python3 scripts/bench_rag.py --docs 2000 --output after.json --compare before.json
+  python3 scripts/bench_rag.py --docs 2000 --projects 20 --filter-project      # filtered retrieval
+  python3 scripts/bench_rag.py --ollama-url http://localhost:11434   # real Ollama
+"""
+import argparse
+import contextlib
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+RAG_DIR = SCRIPT_DIR.parent
+
+
+def synthetic_corpus(out_dir: Path, docs: int, doc_kb: float, vocab_size: int, seed: int, projects: int = 1) -> list[Path]:
+    """Markdown files with Zipf-distributed words from a generated vocabulary, spread over project dirs."""
+    rnd = random.Random(seed)
+    syllables = ["ka", "lo", "mi", "ra", "te", "su", "vo", "ne", "di", "pa", "qu", "zen", "tor", "bel", "fi", "gro"]
+    vocab = sorted({"".join(rnd.choice(syllables) for _ in range(rnd.randint(2, 4))) for _ in range(vocab_size * 2)})[:vocab_size]
+    rnd.shuffle(vocab)
+    weights = [1 / (i + 1) for i in range(len(vocab))]
+    paths = []
+    for d in range(docs):
+        lines, size, n = [f"# Document {d}", ""], 0, 0
+        while size < doc_kb * 1024:
+            n += 1
+            para = []
+            for _ in range(rnd.randint(3, 7)):
+                para.append(" ".join(rnd.choices(vocab, weights, k=rnd.randint(8, 20))).capitalize() + ".")
+            block = f"## Section {n}\n\n" + " ".join(para) + "\n"
+            lines.append(block)
+            size += len(block)
+        p = out_dir / f"proj{d % projects:03d}" / "docs" / f"doc{d:05d}.md"
+        p.parent.mkdir(parents=True, exist_ok=True)
+        p.write_text("\n".join(lines), encoding="utf-8")
+        paths.append(p)
+    return paths
+
+
+def make_queries(paths: list[Path], n: int, seed: int) -> list[str]:
+    """Queries of 3-6 words taken from random sentences in the corpus."""
+    rnd = random.Random(seed + 1)
+    queries = []
+    for _ in range(n):
+        text = rnd.choice(paths).read_text(encoding="utf-8")
+        sentences = [s for s in text.split(". ") if len(s.split()) > 6 and not s.startswith("#")]
+        words = rnd.choice(sentences).split()
+        k = rnd.randint(3, 6)
+        start = rnd.randint(0, len(words) - k)
+        queries.append(" ".join(words[start:start + k]).strip(".").lower())
+    return queries
+
+
+def percentiles(samples_ms: list[float]) -> dict:
+    if not samples_ms:
+        return {"count": 0}
+    s = sorted(samples_ms)
+
+    def q(p):
+        return round(s[min(len(s) - 1, int(p * len(s)))], 2)
+    return {"count": len(s), "mean": round(sum(s) / len(s), 2), "p50": q(0.5), "p95": q(0.95), "p99": q(0.99), "max": round(s[-1], 2)}
+
+
+def run_load(call, queries: list[str], mode: str, concurrency: int, rate: float, requests: int, duration: float) -> dict:
+    """Closed loop: `concurrency` workers issue requests back to back. Open loop: arrivals
+    at `rate`/s (Poisson); latency counts from the scheduled arrival, so queueing shows."""
+    from concurrent.futures import ThreadPoolExecutor
+    lat, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(10 ** 12))
+    t_start = time.perf_counter()
+    deadline = t_start + duration if duration else None
+
+    def one(i: int, scheduled: float):
+        try:
+            call(queries[i % len(queries)])
+            ok = True
+        except Exception as e:
+            ok = False
+            with lock:
+                errors.append(str(e)[:200])
+        with lock:
+            if ok:
+                lat.append((time.perf_counter() - scheduled) * 1000)
+
+    if mode == "closed":
+        def worker():
+            while True:
+                i = next(counter)
+                if (requests and i >= requests) or (deadline and time.perf_counter() >= deadline):
+                    return
+                one(i, time.perf_counter())
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    else:
+        rnd = random.Random(0)
+        pool = ThreadPoolExecutor(max_workers=max(concurrency, 64))
+        scheduled = t_start
+        i = 0
+        while (not requests or i < requests) and (not deadline or scheduled < deadline):
+            scheduled += rnd.expovariate(rate)
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(one, i, scheduled)
+            i += 1
+        pool.shutdown(wait=True)
+    elapsed = time.perf_counter() - t_start
+    return {
+        "requests": len(lat) + len(errors),
+        "errors": len(errors),
+        "error_samples": errors[:5],
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(len(lat) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": percentiles(lat),
+    }
+
+
+def compare(current: dict, baseline: dict) -> dict:
+    """Per-stage and end-to-end p50/p95 change (%) vs a previous run; positive = slower."""
+    def delta(a, b):
+        return round((a - b) / b * 100, 1) if b else None
+    out = {"latency_ms": {k: delta(current["load"]["latency_ms"].get(k, 0), baseline["load"]["latency_ms"].get(k, 0))
+                          for k in ("p50", "p95", "p99")}}
+    out["throughput_rps"] = delta(current["load"]["throughput_rps"], baseline["load"]["throughput_rps"])
+    stages = {}
+    for stage, cur in current.get("stages", {}).items():
+        base = baseline.get("stages", {}).get(stage)
+        if base:
+            stages[stage] = {k: delta(cur[k], base[k]) for k in ("p50_ms", "p95_ms")}
+    out["stages"] = stages
+    return out
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=RAG_DIR, capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except Exception:
+        return None
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark the RAG pipeline in-process")
+    p.add_argument("--target", choices=["retrieval", "query"], default="retrieval", help="retrieve_docs only, or run_query with generation")
+    p.add_argument("--mode", choices=["closed", "open"], default="closed", help="closed: fixed workers; open: fixed arrival rate")
+    p.add_argument("--concurrency", type=int, default=4, help="closed-loop workers (open loop: minimum pool size)")
+    p.add_argument("--rate", type=float, default=10.0, help="open loop: requests per second")
+    p.add_argument("--requests", type=int, default=200, help="measured requests (0 = until --duration)")
+    p.add_argument("--duration", type=float, default=0, help="stop after this many seconds (0 = until --requests)")
+    p.add_argument("--warmup", type=int, default=20, help="unmeasured requests before the run")
+    p.add_argument("--docs", type=int, default=200, help="synthetic corpus: documents")
+    p.add_argument("--doc-kb", type=float, default=4, help="synthetic corpus: KB per document")
+    p.add_argument("--vocab", type=int, default=5000, help="synthetic corpus: vocabulary size")
+    p.add_argument("--projects", type=int, default=1, help="synthetic corpus: project directories the docs are spread over")
+    p.add_argument("--filter-project", action="store_true", help="restrict retrieval to the first project (--filter-source)")
+    p.add_argument("--path-depth", type=int, help="index: directory levels stored per chunk (default: rag.PATH_DEPTH; 0 = off)")
+    p.add_argument("--vector-store", choices=["chroma", "numpy"], help="index: vector backend (default: rag.VECTOR_STORE)")
+    p.add_argument("--vector-dtype", choices=["float16", "int8"], help="index: numpy backend vector precision")
+    p.add_argument("--ivf-lists", type=int, help="index: numpy backend IVF partitions (0 = exact)")
+    p.add_argument("--queries", type=int, default=100, help="distinct queries (cycled)")
+    p.add_argument("--seed", type=int, default=7)
+    p.add_argument("--rerank", action="store_true", help="enable the cross-encoder (needs sentence-transformers)")
+    p.add_argument("--cache", action="store_true", help="keep answer/retrieval/semantic caches on (default: measure cold paths)")
+    p.add_argument("--ollama-url", help="use this Ollama instead of the built-in stub")
+    p.add_argument("--stub-embed-ms", type=float, default=5, help="stub latency per embedding request")
+    p.add_argument("--stub-chat-ms", type=float, default=50, help="stub latency before the first token")
+    p.add_argument("--stub-token-ms", type=float, default=10, help="stub latency per token")
+    p.add_argument("--work-dir", help="corpus/index/caches/logs (default: temp dir, removed afterwards)")
+    p.add_argument("--output", help="write the JSON result here")
+    p.add_argument("--compare", help="previous JSON result to diff against")
+    args = p.parse_args()
+
+    work = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="rag-bench-"))
+    work.mkdir(parents=True, exist_ok=True)
+    stub = None
+    if args.ollama_url:
+        ollama_url = args.ollama_url
+    else:
+        sys.path.insert(0, str(SCRIPT_DIR))
+        import stub_ollama
+        stub, ollama_url, _ = stub_ollama.start(0, 384, args.stub_embed_ms, args.stub_chat_ms, args.stub_token_ms)
+    # rag reads these at import time: keep every cache and log inside the work dir
+    os.environ["OLLAMA_URL"] = ollama_url
+    os.environ["HOME"] = str(work / "home")
+    os.environ["RAG_SEMANTIC_CACHE"] = "1" if args.cache else "0"
+    sys.path.insert(0, str(RAG_DIR))
+    import rag
+
+    try:
+        corpus = synthetic_corpus(work / "corpus", args.docs, args.doc_kb, args.vocab, args.seed, max(1, args.projects))
+        queries = make_queries(corpus, args.queries, args.seed)
+        ctx = rag.RagContext(work / "index")
+        cli = ["query", "--index-dir", str(ctx.index_dir)]
+        if args.filter_project:
+            cli += ["--filter-source", str((work / "corpus" / "proj000").resolve())]
+        if args.path_depth is not None:
+            cli += ["--path-depth", str(args.path_depth)]
+        for flag in ("vector_store", "vector_dtype", "ivf_lists"):
+            if getattr(args, flag) is not None:
+                cli += ["--" + flag.replace("_", "-"), str(getattr(args, flag))]
+        if not args.rerank:
+            cli.append("--no-rerank")
+        if not args.cache:
+            cli.append("--no-cache")
+        opts = rag.build_parser().parse_args(cli)
+
+        t0 = time.perf_counter()
+        with contextlib.redirect_stdout(sys.stderr):  # keep stdout pure JSON
+            indexed = rag.run_index(ctx, [str(p) for p in corpus], opts)
+        index_s = time.perf_counter() - t0
+        print(f"Indexed {indexed.get('chunks', 0)} chunks from {len(corpus)} docs in {index_s:.1f}s", file=sys.stderr)
+
+        if args.target == "query":
+            def call(q):
+                result = rag.run_query(ctx, q, opts)
+                if "error" in result:
+                    raise RuntimeError(result["error"])
+        else:
+            def call(q):
+                rag.retrieve_docs(ctx, q, opts)
+
+        for q in queries[:args.warmup]:
+            call(q)
+        rag.metrics = rag.StageMetrics()  # measure the run only
+        print(f"Running {args.mode}-loop {args.target} load...", file=sys.stderr)
+        load = run_load(call, queries, args.mode, args.concurrency, args.rate, args.requests, args.duration)
+
+        result = {
+            "commit": git_commit(),
+            "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare", "work_dir")},
+            "stub_ollama": stub is not None,
+            "index": {
+                "chunks": indexed.get("chunks", 0),
+                "seconds": round(index_s, 3),
+                "chunks_per_s": round(indexed.get("chunks", 0) / index_s, 1) if index_s else 0.0,
+                "backend": ctx.backend(),
+                "bytes": sum(f.stat().st_size for f in ctx.index_dir.rglob("*") if f.is_file()),
+            },
+            "load": load,
+            "stages": rag.metrics.snapshot(),
+        }
+        if args.compare:
+            result["compare"] = compare(result, json.loads(Path(args.compare).read_text()))
+        text = json.dumps(result, indent=2)
+        if args.output:
+            Path(args.output).write_text(text + "\n")
+        print(text)
+    finally:
+        if stub is not None:
+            stub.shutdown()
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
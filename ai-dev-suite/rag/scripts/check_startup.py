@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Startup budget check for the CLI cache-hit path (`rag.py query` answered from cache).
+
+Indexes a small document and asks one question (a miss, which fills the answer
+cache), then repeats the question as fresh `python3 rag.py` processes, like the
+AI Dev Suite shelling out does. Fails (exit 1) if a hit imports a heavy
+dependency, or if its median wall time exceeds a bare interpreter's by more than
+--budget-ms. By default a local stub Ollama (scripts/stub_ollama.py) serves the
+miss, and all state (index, caches, rag.log) lives in a temp dir.
+
+Usage:
+  python3 scripts/check_startup.py                    # 150 ms budget over `python3 -c pass`
+  python3 scripts/check_startup.py --budget-ms 100 --runs 10
+  python3 scripts/check_startup.py --ollama-url http://localhost:11434   # real Ollama for the miss
+"""
+import argparse
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+SCRIPT_DIR = Path(__file__).resolve().parent
+RAG_PY = SCRIPT_DIR.parent / "rag.py"
+
+# Must stay off the cache-hit path (top-level package names)
+HEAVY = {
+    "chromadb", "numpy", "requests", "urllib3", "rank_bm25", "sentence_transformers", "torch",
+    "tiktoken", "redis", "pypdf", "docx", "trafilatura", "duckduckgo_search",
+}
+
+DOC = """# Startup check
+
+The cache-hit path answers a repeated question from the persistent answer cache.
+It parses arguments, computes the cache key and reads the cache with the standard
+library only, so chromadb, numpy and requests are never imported.
+"""
+QUESTION = "Which modules does the cache-hit path avoid?"
+
+
+def run(cmd: list[str], env: dict, check: bool = True) -> tuple[float, subprocess.CompletedProcess]:
+    t0 = time.perf_counter()
+    proc = subprocess.run(cmd, env=env, capture_output=True, text=True, timeout=600)
+    elapsed = time.perf_counter() - t0
+    if check and proc.returncode != 0:
+        sys.exit(f"Command failed ({proc.returncode}): {' '.join(cmd)}\n{proc.stdout}{proc.stderr}")
+    return elapsed, proc
+
+
+def imported_modules(importtime_stderr: str) -> set[str]:
+    """Top-level package names from `python -X importtime` output."""
+    names = set()
+    for line in importtime_stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            name = line.rsplit("|", 1)[1].strip()
+            if name and name != "package":
+                names.add(name.split(".")[0])
+    return names
+
+
+def main():
+    p = argparse.ArgumentParser(description="Check the startup time and imports of a CLI cache hit")
+    p.add_argument("--budget-ms", type=float, default=150, help="allowed median wall time over a bare interpreter")
+    p.add_argument("--runs", type=int, default=5, help="timed cache-hit runs")
+    p.add_argument("--ollama-url", help="use this Ollama for the miss instead of the built-in stub")
+    p.add_argument("--work-dir", help="index/caches/logs (default: temp dir, removed afterwards)")
+    args = p.parse_args()
+
+    work = Path(args.work_dir) if args.work_dir else Path(tempfile.mkdtemp(prefix="rag-startup-"))
+    work.mkdir(parents=True, exist_ok=True)
+    stub = None
+    if args.ollama_url:
+        ollama_url = args.ollama_url
+    else:
+        sys.path.insert(0, str(SCRIPT_DIR))
+        import stub_ollama
+        stub, ollama_url, _ = stub_ollama.start(0, 384, 0, 0, 0)
+    env = {**os.environ, "HOME": str(work / "home"), "OLLAMA_URL": ollama_url}
+    env.pop("RAG_REDIS_URL", None)  # measure the local disk tier
+    env.pop("RAG_CACHE_DISK", None)
+    try:
+        (work / "docs").mkdir(exist_ok=True)
+        (work / "docs" / "startup.md").write_text(DOC)
+        rag = [sys.executable, str(RAG_PY)]
+        index = ["--index-dir", str(work / "index")]
+        run(rag + ["index", str(work / "docs")] + index, env)
+        miss_s, miss = run(rag + ["query", QUESTION, "--no-rerank"] + index, env)
+        answer = miss.stdout.strip()
+
+        _, traced = run([sys.executable, "-X", "importtime", str(RAG_PY), "query", QUESTION, "--no-rerank"] + index, env)
+        heavy = sorted(imported_modules(traced.stderr) & HEAVY)
+        baseline = statistics.median(run([sys.executable, "-c", "pass"], env)[0] for _ in range(args.runs))
+        hits = []
+        for _ in range(args.runs):
+            elapsed, proc = run(rag + ["query", QUESTION, "--no-rerank"] + index, env)
+            if proc.stdout.strip() != answer:
+                sys.exit(f"Not served from cache:\n{proc.stdout}")
+            hits.append(elapsed)
+        hit = statistics.median(hits)
+        overhead_ms = (hit - baseline) * 1000
+        result = {
+            "miss_ms": round(miss_s * 1000, 1),
+            "hit_ms": round(hit * 1000, 1),
+            "interpreter_ms": round(baseline * 1000, 1),
+            "overhead_ms": round(overhead_ms, 1),
+            "budget_ms": args.budget_ms,
+            "heavy_imports": heavy,
+        }
+        print(json.dumps(result, indent=2))
+        failed = []
+        if heavy:
+            failed.append(f"cache hit imported {', '.join(heavy)}")
+        if overhead_ms > args.budget_ms:
+            failed.append(f"cache hit took {overhead_ms:.0f} ms over the interpreter (budget {args.budget_ms:.0f} ms)")
+        if failed:
+            sys.exit("FAIL: " + "; ".join(failed))
+        print("OK", file=sys.stderr)
+    finally:
+        if stub is not None:
+            stub.shutdown()
+        if not args.work_dir:
+            shutil.rmtree(work, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+"""Deterministic stand-in for the Ollama HTTP API, for benchmarks and offline runs.
+
+Serves /api/embed, /api/embeddings, /api/chat (streaming and not) and /api/tags.
+Embeddings are hashed bag-of-words vectors, so the same text always gets the same
+vector and texts sharing words are similar. Latency is configurable per request
+and per generated token, so runs measure the RAG pipeline rather than a model.
+
+Usage:
+    python3 scripts/stub_ollama.py [--port 11435] [--embed-ms 5] [--token-ms 10]
+    OLLAMA_URL=http://127.0.0.1:11435 python3 rag.py query "..."
+"""
+import argparse
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER = "Based on the context, the indexed documents describe this topic [1]. See also [doc 2]."
+
+
+def embed(text: str, dim: int) -> list[float]:
+    v = [0.0] * dim
+    for word in text.lower().split():
+        v[int(hashlib.md5(word.encode("utf-8")).hexdigest(), 16) % dim] += 1.0
+    norm = sum(x * x for x in v) ** 0.5 or 1.0
+    return [x / norm for x in v]
+
+
+def make_handler(dim: int, embed_ms: float, chat_ms: float, token_ms: float, counts: dict):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # headers and body are separate writes
+
+        def log_message(self, format, *a):
+            pass
+
+        def _json(self, payload: dict, code: int = 200):
+            data = json.dumps(payload).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/api/tags":
+                self._json({"models": [{"name": "stub"}]})
+            else:
+                self._json(counts)
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            route = self.path.rstrip("/")
+            counts[route] = counts.get(route, 0) + 1
+            if route == "/api/embed":
+                texts = body.get("input") or []
+                texts = [texts] if isinstance(texts, str) else texts
+                time.sleep(embed_ms / 1000)
+                self._json({"embeddings": [embed(t, dim) for t in texts]})
+            elif route == "/api/embeddings":
+                time.sleep(embed_ms / 1000)
+                self._json({"embedding": embed(body.get("prompt", ""), dim)})
+            elif route == "/api/chat":
+                self._chat(body)
+            else:
+                self._json({"error": "not found"}, 404)
+
+        def _chat(self, body: dict):
+            words = [w + " " for w in ANSWER.split(" ")]
+            words[-1] = words[-1].rstrip()
+            time.sleep(chat_ms / 1000)
+            if not body.get("stream"):
+                time.sleep(token_ms * len(words) / 1000)
+                self._json({"message": {"role": "assistant", "content": "".join(words)}, "done": True, "eval_count": len(words)})
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+            def chunk(payload: dict):
+                data = (json.dumps(payload) + "\n").encode("utf-8")
+                self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+                self.wfile.flush()
+
+            t0 = time.time()
+            for w in words:
+                time.sleep(token_ms / 1000)
+                chunk({"message": {"role": "assistant", "content": w}, "done": False})
+            chunk({"message": {"role": "assistant", "content": ""}, "done": True,
+                   "eval_count": len(words), "eval_duration": int((time.time() - t0) * 1e9)})
+            self.wfile.write(b"0\r\n\r\n")
+
+    return Handler
+
+
+def start(port: int = 0, dim: int = 384, embed_ms: float = 5, chat_ms: float = 50, token_ms: float = 10):
+    """Run the stub on a background thread. Returns (server, base_url, counts)."""
+    counts = {}
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(dim, embed_ms, chat_ms, token_ms, counts))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-ollama", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}", counts
+
+
+def main():
+    p = argparse.ArgumentParser(description="Deterministic stub Ollama server")
+    p.add_argument("--port", type=int, default=11435)
+    p.add_argument("--dim", type=int, default=384, help="Embedding dimension")
+    p.add_argument("--embed-ms", type=float, default=5, help="Latency per embedding request")
+    p.add_argument("--chat-ms", type=float, default=50, help="Latency before the first token (prompt eval)")
+    p.add_argument("--token-ms", type=float, default=10, help="Latency per generated token")
+    args = p.parse_args()
+    server, url, _ = start(args.port, args.dim, args.embed_ms, args.chat_ms, args.token_ms)
+    print(f"Stub Ollama on {url} (Ctrl+C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()